@@ -5,6 +5,13 @@
 # See: http://www.adeveloperdiary.com/data-science/machine-learning/introduction-to-hidden-markov-model/
 
 import numpy as np
+import os
+import struct
+import tempfile
+import zipfile
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 # Hidden Markov Model (θ) has with following parameters :
 # 
@@ -14,6 +21,117 @@ import numpy as np
 # B = Emission Probability Matrix (Also known as Observation Likelihood) (bjk)
 # π = Initial Probability Distribution
 
+# Transition Operators: the scaled, vectorized and log-scale algorithms below only use the
+# Transition Probability Matrix A through three operations, so instead of a dense matrix they
+# also accept any object implementing them, together with a shape attribute:
+#
+#   dot_left(v)  = v·A                                  (forward step)
+#   dot_right(v) = A·v                                  (backward step)
+#   max_log(ω)   = max(i, ωi + log aij), argmax(i, ...)  (Viterbi step)
+#
+# All of them work on the last axis of v and ω. Transition matrices with a known structure can
+# then do each step in less than the O(M²) operations of a dense matrix.
+
+class DenseTransitions():
+    def __init__(self, a=None, log_a=None):
+        self._matrix = a
+        self._log_matrix = log_a
+        self.shape = (a if a is not None else log_a).shape
+
+    @property
+    def matrix(self):
+        if self._matrix is None:
+            self._matrix = np.exp(self._log_matrix)
+        return self._matrix
+
+    @property
+    def log_matrix(self):
+        if self._log_matrix is None:
+            with np.errstate(divide='ignore'):
+                self._log_matrix = np.log(self._matrix)
+        return self._log_matrix
+
+    def dot_left(self, v):
+        return v.dot(self.matrix)
+
+    def dot_right(self, v):
+        return v.dot(self.matrix.T)
+
+    def max_log(self, omega):
+        # probability[i, j] = ωi + log aij
+        probability = omega[..., :, np.newaxis] + self.log_matrix
+        return np.max(probability, axis=-2), np.argmax(probability, axis=-2)
+
+# Transition matrix with aii = p_same for all i and aij = p_other for all i ≠ j. Every step is
+# O(M), because the sum or the best of the previous states is global, plus a diagonal correction:
+#
+#   (v·A)j = p_other·∑i vi + (p_same - p_other)·vj
+#   max(i, ωi + log aij) = max(ωj + log p_same, max(i≠j, ωi) + log p_other)
+#
+# where max(i≠j, ωi) is the best of ω, or its second best when j is the best state itself. The
+# dense matrices are only built when asked for, and kept (read-only) until the probabilities change.
+
+class DiagonalTransitions():
+    def __init__(self, M, prob_same_state, prob_other_state=None, dtype=np.float64):
+        self.shape = (M, M)
+        self.dtype = np.dtype(dtype)
+        self.prob_same_state = prob_same_state
+        self.prob_other_state = (1. - prob_same_state) / (M - 1) if prob_other_state is None else prob_other_state
+        self.cache = {}
+
+    def cached(self, name, function):
+        key = (self.prob_same_state, self.prob_other_state, self.dtype)
+        value = self.cache.get(name)
+        if value is None or value[0] != key:
+            value = (key, function())
+            value[1].flags.writeable = False
+            self.cache[name] = value
+        return value[1]
+
+    @property
+    def matrix(self):
+        def matrix():
+            a = np.full(self.shape, self.prob_other_state, dtype=self.dtype)
+            np.fill_diagonal(a, self.prob_same_state)
+            return a
+        return self.cached('matrix', matrix)
+
+    @property
+    def log_matrix(self):
+        return self.cached('log_matrix', lambda: np.log(self.matrix))
+
+    def dot_left(self, v):
+        prob_same_state, prob_other_state = self.dtype.type(self.prob_same_state), self.dtype.type(self.prob_other_state)
+        return prob_other_state * np.sum(v, axis=-1, keepdims=True) + (prob_same_state - prob_other_state) * v
+
+    def dot_right(self, v):
+        # A is symmetric
+        return self.dot_left(v)
+
+    def max_log(self, omega):
+        states = np.arange(self.shape[0])
+
+        first = np.argmax(omega, axis=-1)[..., np.newaxis]
+        others = np.where(states == first, -np.inf, omega)
+        second = np.argmax(others, axis=-1)[..., np.newaxis]
+
+        # Best previous state other than j itself. When all the states but the best one have
+        # ω = -∞, the best state has no other previous state (and argmax returns it again)
+        other_prev = np.where(states == first, second, first)
+        other = np.take_along_axis(omega, other_prev, axis=-1) + np.log(self.dtype.type(self.prob_other_state))
+        other = np.where((states == first) & (np.take_along_axis(others, second, axis=-1) == -np.inf), -np.inf, other)
+        same = omega + np.log(self.dtype.type(self.prob_same_state))
+
+        # Ties are resolved towards the lowest state index, as np.argmax does for a dense matrix
+        prev = np.where((same > other) | ((same == other) & (states < other_prev)), states, other_prev)
+        return np.maximum(same, other), prev
+
+
+def transition_operator(a):
+    # Dense matrices are wrapped, transition operators are used as they are
+    return DenseTransitions(a) if isinstance(a, np.ndarray) else a
+
+
 # Evaluation Problem: Given the model (θ), we want to determine the probability that
 # a particular sequence of visible states/symbol (V) that was generated from the model (θ).
 
@@ -52,6 +170,137 @@ def backward(V, a, b):
 
     return beta
 
+# Vectorized versions of the Forward and Backward Algorithms. The inner loop over the states j is
+# replaced by a single vector-matrix product per time step. The loop-based forward() and backward()
+# above are kept as the reference implementation to compare against.
+
+def forward_vectorized(V, a, b, initial_distribution):
+    a = transition_operator(a)
+    alpha = np.zeros((V.shape[0], a.shape[0]))
+    alpha[0, :] = initial_distribution * b[:, V[0]]
+
+    # α(t+1) = (α(t)·A) ∘ b(v(t+1))
+    for t in range(1, V.shape[0]):
+        alpha[t, :] = a.dot_left(alpha[t - 1]) * b[:, V[t]]
+
+    return alpha
+
+
+def backward_vectorized(V, a, b):
+    a = transition_operator(a)
+    beta = np.zeros((V.shape[0], a.shape[0]))
+    beta[V.shape[0] - 1] = np.ones((a.shape[0]))
+
+    # β(t) = A·(β(t+1) ∘ b(v(t+1)))
+    for t in range(V.shape[0] - 2, -1, -1):
+        beta[t, :] = a.dot_right(beta[t + 1] * b[:, V[t + 1]])
+
+    return beta
+
+# Scaled versions of the Forward and Backward Algorithms. The raw probabilities αj(t) decay
+# geometrically with t, so they underflow to zero after a few hundred observations. Instead,
+# α(t) is normalized at every time step so that it sums to 1, and the normalization factor
+# c(t) is kept:
+#
+#   α^(t) = α(t) / (c(0)·c(1)···c(t))
+#   P(V|θ) = c(0)·c(1)···c(T-1)  ->  log P(V|θ) = ∑t=0..T-1, log c(t)
+#
+# The backward variables are scaled with the same factors, so that α^j(t)·β^j(t) is directly
+# the posterior probability of being in hidden state j at time step t. The arrays are computed
+# with the precision (dtype) of the emission probabilities (at least float32), which can also be
+# any object returning their columns as b[:, v].
+
+def forward_scaled(V, a, b, initial_distribution):
+    a = transition_operator(a)
+    T = V.shape[0]
+    emissions = b[:, V[0]]
+    dtype = np.result_type(emissions, np.float32)
+    alpha = np.zeros((T, a.shape[0]), dtype=dtype)
+    c = np.zeros(T, dtype=dtype)
+
+    alpha[0, :] = initial_distribution * emissions
+    c[0] = np.sum(alpha[0])
+    alpha[0, :] /= c[0]
+
+    for t in range(1, T):
+        alpha[t, :] = a.dot_left(alpha[t - 1]) * b[:, V[t]]
+        c[t] = np.sum(alpha[t])
+        alpha[t, :] /= c[t]
+
+    log_likelihood = np.sum(np.log(c))
+
+    return alpha, c, log_likelihood
+
+
+def backward_scaled(V, a, b, c):
+    a = transition_operator(a)
+    T = V.shape[0]
+    beta = np.zeros((T, a.shape[0]), dtype=np.result_type(c))
+    beta[T - 1] = np.ones((a.shape[0]))
+
+    for t in range(T - 2, -1, -1):
+        beta[t, :] = a.dot_right(beta[t + 1] * b[:, V[t + 1]]) / c[t + 1]
+
+    return beta
+
+
+# Checkpointed Forward-Backward Algorithm, for very long sequences. The full algorithm keeps the
+# T×M arrays α and β in memory. Here the forward pass only keeps α^(t) every L time steps (L = √T
+# by default) and all the scaling factors c(t). The backward pass then goes through the segments
+# between checkpoints from the last one to the first one, recomputing the α^(t) of each segment
+# from its checkpoint. The posteriors γ(t) = α^(t)·β^(t) are produced one segment at a time, as
+# (first time step, L×M block) pairs, so the memory used is O(√T·M + T) with about twice the
+# computation, and the values are exactly the same as with forward_scaled() and backward_scaled().
+
+def posteriors_checkpointed(V, a, b, initial_distribution, checkpoint_interval=None):
+    a = transition_operator(a)
+    T = V.shape[0]
+    L = checkpoint_interval if checkpoint_interval else max(1, int(np.ceil(np.sqrt(T))))
+
+    c = np.zeros(T)
+    checkpoints = []
+
+    alpha = initial_distribution * b[:, V[0]]
+    c[0] = np.sum(alpha)
+    alpha /= c[0]
+    checkpoints.append(alpha)
+
+    for t in range(1, T):
+        alpha = a.dot_left(alpha) * b[:, V[t]]
+        c[t] = np.sum(alpha)
+        alpha /= c[t]
+        if t % L == 0:
+            checkpoints.append(alpha)
+
+    beta = np.ones((a.shape[0]))
+
+    for k in range(len(checkpoints) - 1, -1, -1):
+        start = k * L
+        end = min(start + L, T)
+
+        alpha = np.zeros((end - start, a.shape[0]))
+        alpha[0] = checkpoints[k]
+        for t in range(start + 1, end):
+            alpha[t - start] = a.dot_left(alpha[t - start - 1]) * b[:, V[t]]
+            alpha[t - start] /= c[t]
+
+        gamma = np.zeros(alpha.shape)
+        for t in range(end - 1, start - 1, -1):
+            if t < T - 1:
+                beta = a.dot_right(beta * b[:, V[t + 1]]) / c[t + 1]
+            gamma[t - start] = alpha[t - start] * beta
+
+        # The checkpoint is not needed any more
+        checkpoints[k] = None
+
+        yield start, gamma
+
+
+def forward_backward_checkpointed(V, a, b, initial_distribution, checkpoint_interval=None):
+    gamma = np.zeros((V.shape[0], transition_operator(a).shape[0]))
+    for start, gamma_segment in posteriors_checkpointed(V, a, b, initial_distribution, checkpoint_interval):
+        gamma[start:start + gamma_segment.shape[0]] = gamma_segment
+    return gamma
 
 # Learning Problem: Once the high-level structure (Number of Hidden & Visible States) of
 # the model is defined, we want to estimate the Transition (a) & Emission (b) Probabilities
@@ -87,10 +336,171 @@ def baum_welch(V, a, b, initial_distribution, n_iter=100):
 
     return (a, b)
 
+# Expectation step of Baum-Welch, without building the M×M×T tensor ξ. Using the scaled
+# forward and backward variables:
+#
+#   γj(t) = α^j(t)·β^j(t)
+#   ξij(t) = α^i(t)·aij·bjkv(t+1)·β^j(t+1) / c(t+1)
+#
+# Only the sum of ξij(t) over the time steps is needed to re-estimate A, and since aij does not
+# depend on t it can be taken out of the sum:
+#
+#   ∑t ξij(t) = aij·∑t α^i(t)·wj(t+1),  with  wj(t+1) = bjkv(t+1)·β^j(t+1) / c(t+1)
+#
+# The sum of the outer products α(t)⊗w(t+1) is accumulated into an M×M matrix with one matrix
+# product, so the memory used is O(M² + T·M) and there are no loops over the states.
+
+def expected_counts(V, a, b, initial_distribution):
+    a = transition_operator(a)
+    alpha, c, log_likelihood = forward_scaled(V, a, b, initial_distribution)
+    beta = backward_scaled(V, a, b, c)
+
+    gamma = alpha * beta
+
+    w = b[:, V[1:]].T * beta[1:] / c[1:].reshape((-1, 1))
+    transition_counts = a.matrix * alpha[:-1].T.dot(w)
+
+    # Add γ(t) to the column of the visible symbol v(t)
+    emission_counts = np.zeros(b.shape)
+    np.add.at(emission_counts.T, V, gamma)
+
+    return transition_counts, emission_counts, log_likelihood
+
+# Maximization step of Baum-Welch: the expected counts are normalized into probabilities
+
+def maximization(transition_counts, emission_counts):
+    a = transition_counts / np.sum(transition_counts, axis=1).reshape((-1, 1))
+    b = emission_counts / np.sum(emission_counts, axis=1).reshape((-1, 1))
+    return (a, b)
+
+
+def baum_welch_vectorized(V, a, b, initial_distribution, n_iter=100):
+    for n in range(n_iter):
+        transition_counts, emission_counts, log_likelihood = expected_counts(V, a, b, initial_distribution)
+        a, b = maximization(transition_counts, emission_counts)
+
+    return (a, b)
+
+# Viterbi Training (hard EM): instead of the expected counts of all the possible paths, the
+# transitions and emissions are counted only along the most probable path, and then normalized.
+# Each iteration is a single Viterbi pass plus two histograms, and it stops as soon as the path
+# does not change. The pseudocount keeps the probabilities of the transitions and emissions that
+# have not been seen in the path above zero. The result can be refined afterwards with some
+# iterations of Baum-Welch (baum_welch_iter), which then start from a good estimate.
+
+def viterbi_training(V, a, b, initial_distribution, n_iter=20, pseudocount=1e-3, baum_welch_iter=0):
+    M = a.shape[0]
+    K = b.shape[1]
+
+    S = None
+    for n in range(n_iter):
+        S_next = viterbi_vectorized(V, a, b, initial_distribution)
+        if S is not None and np.array_equal(S, S_next):
+            break
+        S = S_next
+
+        transition_counts = np.bincount(S[:-1] * M + S[1:], minlength=M * M).reshape((M, M)) + pseudocount
+        emission_counts = np.bincount(S * K + V, minlength=M * K).reshape((M, K)) + pseudocount
+        a, b = maximization(transition_counts, emission_counts)
+
+    if baum_welch_iter:
+        a, b = baum_welch_vectorized(V, a, b, initial_distribution, n_iter=baum_welch_iter)
+
+    return (a, b)
+
+# Training over a corpus: the expected counts of every observation sequence are independent of
+# each other, so the E-steps run in a pool of processes (one sequence per task), their counts are
+# added up, and a single M-step re-estimates the parameters from the pooled counts.
+
+def _expected_counts_job(args):
+    return expected_counts(*args)
+
+
+def corpus_expected_counts(sequences, a, b, initial_distribution, executor=None):
+    # Longest sequences first, so that the pool does not end up waiting for a long one at the end
+    jobs = [(V, a, b, initial_distribution) for V in sorted(sequences, key=len, reverse=True)]
+    results = map(_expected_counts_job, jobs) if executor is None else executor.map(_expected_counts_job, jobs)
+
+    transition_counts = np.zeros(a.shape)
+    emission_counts = np.zeros(b.shape)
+    log_likelihood = 0.
+    for sequence_transition_counts, sequence_emission_counts, sequence_log_likelihood in results:
+        transition_counts += sequence_transition_counts
+        emission_counts += sequence_emission_counts
+        log_likelihood += sequence_log_likelihood
+
+    return transition_counts, emission_counts, log_likelihood
+
+
+def baum_welch_corpus(sequences, a, b, initial_distribution, n_iter=100, processes=None):
+    # processes=None uses as many processes as CPU cores, processes=1 runs everything in this process
+    if processes == 1:
+        for n in range(n_iter):
+            transition_counts, emission_counts, log_likelihood = corpus_expected_counts(sequences, a, b, initial_distribution)
+            a, b = maximization(transition_counts, emission_counts)
+        return (a, b)
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for n in range(n_iter):
+            transition_counts, emission_counts, log_likelihood = corpus_expected_counts(sequences, a, b, initial_distribution, executor)
+            a, b = maximization(transition_counts, emission_counts)
+
+    return (a, b)
+
+
+# Parameters of a trained model, saved as a .npz file
+
+def save_parameters(filename, a, b, initial_distribution, **arrays):
+    # Written to a temporary file first, as the arrays could be memory-mapped from the same file
+    temporary_filename = f'{filename}.{os.getpid()}.tmp'
+    with open(temporary_filename, 'wb') as f:
+        np.savez(f, a=a, b=b, initial_distribution=initial_distribution, **arrays)
+    os.replace(temporary_filename, filename)
+
+
+def load_parameters(filename):
+    with np.load(filename) as data:
+        return data['a'], data['b'], data['initial_distribution']
+
+# Baum-Welch until convergence: the log-likelihood of the training sequences, which Baum-Welch
+# never decreases, is computed at every iteration as part of the E-step, and the training stops
+# when its relative improvement falls below tol. It can start from the parameters saved in a file
+# (warm_start), and it returns the log-likelihood of every iteration along with the parameters.
+
+def baum_welch_until_convergence(sequences, a, b, initial_distribution, max_iter=100, tol=1e-4, warm_start=None, processes=1):
+    if isinstance(sequences, np.ndarray) and sequences.ndim == 1:
+        sequences = [sequences]
+
+    if warm_start is not None:
+        a, b, initial_distribution = load_parameters(warm_start)
+
+    executor = ProcessPoolExecutor(max_workers=processes) if processes != 1 else None
+
+    trace = []
+    try:
+        for n in range(max_iter):
+            transition_counts, emission_counts, log_likelihood = corpus_expected_counts(sequences, a, b, initial_distribution, executor)
+            if trace and (log_likelihood - trace[-1]) < tol * abs(trace[-1]):
+                trace.append(log_likelihood)
+                break
+            trace.append(log_likelihood)
+            a, b = maximization(transition_counts, emission_counts)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return a, b, trace
 
 # Decoding Problem: Once we have the estimates for Transition (a) & Emission (b) Probabilities,
 # we can then use the model (θ) to predict the Hidden States W which generated the Visible Sequence V
 
+# The backpointers of the Viterbi Algorithm are stored with the smallest unsigned integer type
+# that can index all the M hidden states (1 byte for up to 256 states, 2 bytes for up to 65536)
+
+def state_index_dtype(M):
+    return np.min_scalar_type(max(M - 1, 0))
+
+
 def viterbi(V, a, b, initial_distribution):
     T = V.shape[0]
     M = a.shape[0]
@@ -98,7 +508,7 @@ def viterbi(V, a, b, initial_distribution):
     omega = np.zeros((T, M))
     omega[0, :] = np.log(initial_distribution * b[:, V[0]])
 
-    prev = np.zeros((T - 1, M))
+    prev = np.zeros((T - 1, M), dtype=state_index_dtype(M))
 
     # ωi(t+1) = max(i, ωi(t)·aij·bjkv(t+1))
 
@@ -116,7 +526,7 @@ def viterbi(V, a, b, initial_distribution):
             omega[t, j] = np.max(probability)
 
     # Path Array
-    S = np.zeros(T)
+    S = np.zeros(T, dtype=np.intp)
 
     # Find the most probable last hidden state
     last_state = np.argmax(omega[T - 1, :])
@@ -134,6 +544,598 @@ def viterbi(V, a, b, initial_distribution):
 
     return S
 
+# Vectorized Viterbi Algorithm in log scale. The logarithms of the Transition (log_a), Emission
+# (log_b) and Initial (log_initial_distribution) Probabilities are computed only once by the
+# caller, and the log-emissions of the whole sequence are gathered with a single indexing
+# operation. Each time step is then a single broadcast sum over an M×M matrix, followed by one
+# max and one argmax over the previous states. Instead of a matrix, log_a can also be a
+# transition operator, which then does the whole step. The decoders work with the precision
+# (dtype) of the log-probabilities they are given: float32 halves the memory traffic of the
+# emissions and of ω, and the resulting path is the same unless two paths are within its
+# rounding errors.
+
+def viterbi_log(V, log_a, log_b, log_initial_distribution):
+    transitions = DenseTransitions(log_a=log_a) if isinstance(log_a, np.ndarray) else log_a
+    T = V.shape[0]
+    M = transitions.shape[0]
+
+    # log bjkv(t) for all the time steps, as a T×M matrix
+    log_emissions = log_b[:, V].T
+
+    omega = log_initial_distribution + log_emissions[0]
+
+    prev = np.zeros((T - 1, M), dtype=state_index_dtype(M))
+
+    for t in range(1, T):
+        omega, prev[t - 1] = transitions.max_log(omega)
+        omega += log_emissions[t]
+
+    # Path Array, starting from the most probable last hidden state
+    S = np.zeros(T, dtype=np.intp)
+    S[T - 1] = np.argmax(omega)
+
+    for t in range(T - 2, -1, -1):
+        S[t] = prev[t, S[t + 1]]
+
+    return S
+
+
+def viterbi_vectorized(V, a, b, initial_distribution, dtype=np.float64):
+    with np.errstate(divide='ignore'):
+        # Transition operators do the Viterbi step in log scale by themselves
+        log_a = np.log(a, dtype=dtype) if isinstance(a, np.ndarray) else a
+        return viterbi_log(V, log_a, np.log(b, dtype=dtype), np.log(initial_distribution, dtype=dtype))
+
+# Batched Viterbi Algorithm, decoding B sequences of different lengths at the same time. The
+# sequences are padded to the length T of the longest one, and each time step is done for the
+# whole batch at once, so the cost of each step of the Python loop is shared by all of them. When
+# a sequence has already ended, its ω is kept as it is and its backpointers point to the same
+# state, so that the backtracking of the whole batch can also start at the last time step.
+
+def viterbi_batch(sequences, log_a, log_b, log_initial_distribution):
+    transitions = DenseTransitions(log_a=log_a) if isinstance(log_a, np.ndarray) else log_a
+    M = transitions.shape[0]
+    B = len(sequences)
+
+    lengths = np.array([len(V) for V in sequences])
+    T = np.max(lengths)
+
+    # Padded observations (B×T) and mask of the valid time steps
+    V = np.zeros((B, T), dtype=np.intp)
+    for i, sequence in enumerate(sequences):
+        V[i, :lengths[i]] = sequence
+    mask = np.arange(T) < lengths.reshape((-1, 1))
+
+    # log bjkv(t) of every sequence, as a T×B×M array
+    log_emissions = np.transpose(log_b[:, V.T], (1, 2, 0))
+
+    omega = log_initial_distribution + log_emissions[0]
+
+    states = np.arange(M)
+    prev = np.zeros((T - 1, B, M), dtype=state_index_dtype(M))
+
+    for t in range(1, T):
+        next_omega, prev[t - 1] = transitions.max_log(omega)
+        next_omega += log_emissions[t]
+
+        ended = ~mask[:, t]
+        next_omega[ended] = omega[ended]
+        prev[t - 1, ended] = states
+
+        omega = next_omega
+
+    # Path Arrays of the whole batch, starting from the most probable last hidden states
+    S = np.zeros((B, T), dtype=np.intp)
+    S[:, T - 1] = np.argmax(omega, axis=1)
+
+    batch = np.arange(B)
+    for t in range(T - 2, -1, -1):
+        S[:, t] = prev[t, batch, S[:, t + 1]]
+
+    return [S[i, :lengths[i]] for i in range(B)]
+
+
+# Beam search version of the Viterbi Algorithm, for large numbers of hidden states. At each time
+# step only the states in the beam are extended: the beam_width most probable ones, and/or the
+# ones whose ω is within beam_threshold of the best one (in log scale). Each time step is then
+# O(K·M) instead of O(M²) for a beam of K states, but the result is no longer guaranteed to be
+# the most probable path. It returns the path and its log-probability.
+
+def viterbi_beam(V, log_a, log_b, log_initial_distribution, beam_width=None, beam_threshold=None):
+    log_a = log_a if isinstance(log_a, np.ndarray) else log_a.log_matrix
+    T = V.shape[0]
+    M = log_a.shape[0]
+
+    log_emissions = log_b[:, V].T
+
+    def beam(omega):
+        active = np.arange(M)
+        if beam_threshold is not None:
+            active = np.flatnonzero(omega >= np.max(omega) - beam_threshold)
+        if beam_width is not None and active.shape[0] > beam_width:
+            active = active[np.argpartition(omega[active], -beam_width)[-beam_width:]]
+        return active
+
+    omega = log_initial_distribution + log_emissions[0]
+    active = beam(omega)
+
+    states = np.arange(M)
+    prev = np.zeros((T - 1, M), dtype=state_index_dtype(M))
+
+    for t in range(1, T):
+        # probability[k, j] = ωi(t-1) + log aij, for the states i in the beam
+        probability = omega[active].reshape((-1, 1)) + log_a[active]
+        best = np.argmax(probability, axis=0)
+
+        prev[t - 1] = active[best]
+        omega = probability[best, states] + log_emissions[t]
+        active = beam(omega)
+
+    S = np.zeros(T, dtype=np.intp)
+    S[T - 1] = np.argmax(omega)
+
+    for t in range(T - 2, -1, -1):
+        S[t] = prev[t, S[t + 1]]
+
+    return S, omega[S[T - 1]]
+
+# log P(V, S|θ) of any path of hidden states S
+
+def path_log_probability(V, S, log_a, log_b, log_initial_distribution):
+    log_a = log_a if isinstance(log_a, np.ndarray) else log_a.log_matrix
+    log_emissions = log_b[:, V]
+    return log_initial_distribution[S[0]] + np.sum(log_a[S[:-1], S[1:]]) + np.sum(log_emissions[S, np.arange(V.shape[0])])
+
+# How far the beam search is from the exact Viterbi path: the number of time steps in which both
+# paths differ, and how much lower the log-probability of the beam search path is
+
+def compare_viterbi_beam(V, log_a, log_b, log_initial_distribution, beam_width=None, beam_threshold=None):
+    S_beam, log_probability_beam = viterbi_beam(V, log_a, log_b, log_initial_distribution, beam_width, beam_threshold)
+    S = viterbi_log(V, log_a, log_b, log_initial_distribution)
+    log_probability = path_log_probability(V, S, log_a, log_b, log_initial_distribution)
+    return S_beam, np.sum(S_beam != S), log_probability - log_probability_beam
+
+
+# List Viterbi Algorithm: the n most probable paths, with their log-probabilities, in a single
+# pass. Instead of only the best path ending in each state, it keeps the n best ones, as an M×n
+# array ω, and the backpointers also record the rank of the previous path among those ending in
+# the previous state. Each time step picks the n best of the M·n extended paths for each state,
+# so it costs about n times as much as viterbi_log().
+
+def viterbi_nbest(V, log_a, log_b, log_initial_distribution, n=5):
+    log_a = log_a if isinstance(log_a, np.ndarray) else log_a.log_matrix
+    T = V.shape[0]
+    M = log_a.shape[0]
+
+    log_emissions = log_b[:, V].T
+
+    # ωjk: log-probability of the k-th best path ending in the state j
+    omega = np.full((M, n), -np.inf)
+    omega[:, 0] = log_initial_distribution + log_emissions[0]
+
+    prev_state = np.zeros((T - 1, M, n), dtype=state_index_dtype(M))
+    prev_rank = np.zeros((T - 1, M, n), dtype=state_index_dtype(n))
+
+    for t in range(1, T):
+        # probability[i·n + k, j] = ωik + log aij
+        probability = (omega[:, :, np.newaxis] + log_a[:, np.newaxis, :]).reshape((M * n, M))
+
+        # The n best extended paths for each state j, sorted from the best one
+        best = np.argpartition(-probability, n - 1, axis=0)[:n] if M > 1 else np.arange(n).reshape((-1, 1))
+        order = np.argsort(-np.take_along_axis(probability, best, axis=0), axis=0, kind='stable')
+        best = np.take_along_axis(best, order, axis=0)
+
+        omega = np.take_along_axis(probability, best, axis=0).T + log_emissions[t].reshape((-1, 1))
+        prev_state[t - 1] = (best // n).T
+        prev_rank[t - 1] = (best % n).T
+
+    # The n best paths overall, leaving out the impossible ones
+    flat_omega = omega.reshape(-1)
+    paths = []
+    for index in np.argsort(-flat_omega, kind='stable')[:n]:
+        if not np.isfinite(flat_omega[index]):
+            break
+
+        state, rank = divmod(int(index), n)
+        S = np.zeros(T, dtype=np.intp)
+        S[T - 1] = state
+        for t in range(T - 2, -1, -1):
+            state, rank = prev_state[t, state, rank], prev_rank[t, state, rank]
+            S[t] = state
+
+        paths.append((S, flat_omega[index]))
+
+    return paths
+
+# Parallel versions of the Forward and Viterbi Algorithms, for long sequences. Each time step
+# of both algorithms is a product with the matrix A·diag(b(v(t))), in the (+, ·) semiring for
+# the Forward Algorithm and in the (max, +) semiring, in log scale, for the Viterbi Algorithm.
+# These products are associative, so the sequence is split in chunks that are processed in a
+# pool of processes, in two passes:
+#
+# 1. Each chunk computes the M×M product of all its time steps, which relates the state before
+#    the chunk with the state at its end. This costs O(M³) per time step instead of O(M²).
+# 2. The products are chained to get α (or ω) at the start of each chunk, and then every chunk
+#    runs the usual recursion from there, also in parallel.
+#
+# The first pass does M times more work than the sequential algorithm, so this only pays off
+# when there are many more cores than hidden states. The results are the same as those of
+# forward_scaled() and viterbi_log(), up to rounding errors.
+
+def _chunks(T, n_chunks):
+    # Time steps 1..T-1 split in n_chunks consecutive ranges; the time step 0 is the initial one
+    return [(chunk[0], chunk[-1] + 1) for chunk in np.array_split(np.arange(1, T), n_chunks) if chunk.shape[0] > 0]
+
+
+def _forward_chunk_product(a, emissions):
+    # Product of A·diag(b(v(t))) over the chunk, normalized to avoid underflows
+    product = np.eye(a.shape[0])
+    for t in range(emissions.shape[1]):
+        product = product.dot(a) * emissions[:, t]
+        product /= np.max(product)
+    return product
+
+
+def _forward_chunk(a, emissions, alpha_start):
+    alpha = np.zeros((emissions.shape[1], a.shape[0]))
+    c = np.zeros(emissions.shape[1])
+    previous = alpha_start
+    for t in range(emissions.shape[1]):
+        alpha[t, :] = previous.dot(a) * emissions[:, t]
+        c[t] = np.sum(alpha[t])
+        alpha[t, :] /= c[t]
+        previous = alpha[t]
+    return alpha, c
+
+
+def forward_parallel(V, a, b, initial_distribution, n_chunks=None, processes=None):
+    a = transition_operator(a).matrix
+    T = V.shape[0]
+    chunks = _chunks(T, n_chunks if n_chunks else (processes if processes else os.cpu_count()))
+    emissions = [b[:, V[start:end]] for start, end in chunks]
+
+    alpha = np.zeros((T, a.shape[0]))
+    c = np.zeros(T)
+
+    alpha[0, :] = initial_distribution * b[:, V[0]]
+    c[0] = np.sum(alpha[0])
+    alpha[0, :] /= c[0]
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        products = list(executor.map(_forward_chunk_product, [a] * len(chunks), emissions))
+
+        # Normalized α at the end of the time step before each chunk
+        alpha_start = [alpha[0]]
+        for product in products[:-1]:
+            next_alpha = alpha_start[-1].dot(product)
+            alpha_start.append(next_alpha / np.sum(next_alpha))
+
+        results = executor.map(_forward_chunk, [a] * len(chunks), emissions, alpha_start)
+        for (start, end), (alpha_chunk, c_chunk) in zip(chunks, results):
+            alpha[start:end] = alpha_chunk
+            c[start:end] = c_chunk
+
+    log_likelihood = np.sum(np.log(c))
+
+    return alpha, c, log_likelihood
+
+
+def _viterbi_chunk_product(log_a, log_emissions):
+    # (max, +) product of log A + log b(v(t)) over the chunk
+    product = log_a + log_emissions[0]
+    for t in range(1, log_emissions.shape[0]):
+        product = np.max(product[:, :, np.newaxis] + log_a, axis=1) + log_emissions[t]
+    return product
+
+
+def _viterbi_chunk(log_a, log_emissions, omega_start):
+    M = log_a.shape[0]
+    prev = np.zeros((log_emissions.shape[0], M), dtype=state_index_dtype(M))
+    omega = omega_start
+    for t in range(log_emissions.shape[0]):
+        probability = omega.reshape((-1, 1)) + log_a
+        prev[t] = np.argmax(probability, axis=0)
+        omega = np.max(probability, axis=0) + log_emissions[t]
+    return prev
+
+
+def viterbi_parallel(V, log_a, log_b, log_initial_distribution, n_chunks=None, processes=None):
+    log_a = log_a if isinstance(log_a, np.ndarray) else log_a.log_matrix
+    T = V.shape[0]
+    M = log_a.shape[0]
+    chunks = _chunks(T, n_chunks if n_chunks else (processes if processes else os.cpu_count()))
+
+    log_emissions = log_b[:, V].T
+
+    prev = np.zeros((T - 1, M), dtype=state_index_dtype(M))
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        products = list(executor.map(_viterbi_chunk_product, [log_a] * len(chunks), [log_emissions[start:end] for start, end in chunks]))
+
+        # ω at the end of the time step before each chunk, and at the end of the sequence
+        omega_start = [log_initial_distribution + log_emissions[0]]
+        for product in products:
+            omega_start.append(np.max(omega_start[-1].reshape((-1, 1)) + product, axis=0))
+
+        results = executor.map(_viterbi_chunk, [log_a] * len(chunks), [log_emissions[start:end] for start, end in chunks], omega_start[:-1])
+        for (start, end), prev_chunk in zip(chunks, results):
+            prev[start - 1:end - 1] = prev_chunk
+
+    S = np.zeros(T, dtype=np.intp)
+    S[T - 1] = np.argmax(omega_start[-1])
+
+    for t in range(T - 2, -1, -1):
+        S[t] = prev[t, S[t + 1]]
+
+    return S
+
+
+# Viterbi decoder for sequences that are edited after being decoded (e.g. when the observation
+# of a single time step changes). It keeps all the backpointers, and ω every L time steps,
+# shifted so that its maximum is 0. After a change at the time step t, the recursion is run again
+# from the checkpoint before t, until it reaches a checkpoint with the same ω as before (up to a
+# constant, which is removed by the shift): from there on, all the backpointers are the same as
+# before. The path is then backtracked from that point only until it joins the previous path
+# before the recomputed time steps. The cost of an update depends on how far the change spreads,
+# not on the length of the sequence.
+
+class IncrementalViterbi():
+    def __init__(self, V, log_a, log_b, log_initial_distribution, checkpoint_interval=16, tolerance=1e-9):
+        self.transitions = DenseTransitions(log_a=log_a) if isinstance(log_a, np.ndarray) else log_a
+        self.log_b = log_b
+        self.log_initial_distribution = log_initial_distribution
+        self.checkpoint_interval = checkpoint_interval
+        self.tolerance = tolerance
+
+        self.V = np.array(V)
+        T = self.V.shape[0]
+        M = self.transitions.shape[0]
+
+        self.prev = np.zeros((T - 1, M), dtype=state_index_dtype(M))
+        self.checkpoints = np.zeros(((T - 1) // checkpoint_interval + 1, M), dtype=np.result_type(log_initial_distribution))
+        self.omega = None
+
+        self.run(0, None, None)
+
+        self.S = np.zeros(T, dtype=np.intp)
+        self.S[T - 1] = np.argmax(self.omega)
+        self.backtrack(T - 1, -1)
+
+    def run(self, start, omega, changed):
+        # Viterbi recursion from the time step start, with ω(start - 1) given, until the end of the
+        # sequence or until a checkpoint at or after the changed time step has not changed. Returns
+        # the time step where it stopped.
+        L = self.checkpoint_interval
+        for t in range(start, self.V.shape[0]):
+            if t == 0:
+                omega = self.log_initial_distribution + self.log_b[:, self.V[0]]
+            else:
+                omega, self.prev[t - 1] = self.transitions.max_log(omega)
+                omega += self.log_b[:, self.V[t]]
+
+            max_omega = np.max(omega)
+            if np.isfinite(max_omega):
+                omega -= max_omega
+
+            if t % L == 0:
+                if changed is not None and t >= changed and np.allclose(omega, self.checkpoints[t // L], rtol=0., atol=self.tolerance):
+                    return t
+                self.checkpoints[t // L] = omega
+
+        self.omega = omega
+        return self.V.shape[0] - 1
+
+    def backtrack(self, end, joined):
+        # Follows the backpointers from the time step end, until the path is the same as before at
+        # some time step up to joined
+        for t in range(end - 1, -1, -1):
+            state = self.prev[t, self.S[t + 1]]
+            if t <= joined and state == self.S[t]:
+                break
+            self.S[t] = state
+
+    def update(self, t, observation):
+        self.V[t] = observation
+
+        # Restart from the last checkpoint before the changed time step
+        L = self.checkpoint_interval
+        if t == 0:
+            start, omega = 0, None
+        else:
+            k = (t - 1) // L
+            start, omega = k * L + 1, self.checkpoints[k].copy()
+
+        end = self.run(start, omega, t)
+
+        if end == self.V.shape[0] - 1:
+            self.S[end] = np.argmax(self.omega)
+        self.backtrack(end, start - 1)
+
+        # Number of time steps that were recomputed
+        return end - start + 1
+
+
+# Fixed-lag Viterbi decoder, for observations that arrive one at a time (e.g. live MIDI input).
+# Every push() does a single Viterbi step, and then commits the hidden state of L time steps
+# before, following the backpointers of the currently most probable state. Only the last L
+# vectors of backpointers are kept, so the memory is O(L·M) however long the input is, and ω is
+# shifted so that its maximum is 0, so that it does not keep drifting towards -∞.
+
+class FixedLagViterbi():
+    def __init__(self, log_a, log_b, log_initial_distribution, lag=4):
+        self.transitions = DenseTransitions(log_a=log_a) if isinstance(log_a, np.ndarray) else log_a
+        self.log_b = log_b
+        self.log_initial_distribution = log_initial_distribution
+        self.lag = lag
+        self.reset()
+
+    def reset(self):
+        self.omega = None
+        self.prev = deque(maxlen=self.lag)
+        self.t = 0
+
+    def backtrack(self):
+        # Most probable states of the last (up to L + 1) time steps, oldest first
+        S = [int(np.argmax(self.omega))]
+        for prev in reversed(self.prev):
+            S.append(int(prev[S[-1]]))
+        S.reverse()
+        return S
+
+    def push(self, observation):
+        if self.omega is None:
+            self.omega = self.log_initial_distribution + self.log_b[:, observation]
+        else:
+            self.omega, prev = self.transitions.max_log(self.omega)
+            self.omega += self.log_b[:, observation]
+            self.prev.append(prev)
+
+        max_omega = np.max(self.omega)
+        if np.isfinite(max_omega):
+            self.omega -= max_omega
+
+        self.t += 1
+
+        # Hidden state at t - L, or None during the first L time steps
+        if self.t <= self.lag:
+            return None
+        return self.backtrack()[0]
+
+    def flush(self):
+        # Hidden states that have not been committed yet, at the end of the input
+        if self.omega is None:
+            return []
+        return self.backtrack()[-min(self.t, self.lag):] if self.lag > 0 else []
+
+
+# Arrays of a .npz file saved without compression, memory-mapped instead of read into memory.
+# Each .npy member of the zip file is stored as it is, so its data can be mapped directly from
+# the right offset. Compressed members are read into memory as usual.
+
+def load_npz_memmap(filename):
+    arrays = {}
+    with zipfile.ZipFile(filename) as archive, open(filename, 'rb') as f:
+        for info in archive.infolist():
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+
+            if info.compress_type != zipfile.ZIP_STORED:
+                with archive.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+
+            # Local file header: 30 bytes, then the file name and the extra field
+            f.seek(info.header_offset)
+            header = f.read(30)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+            arrays[name] = np.memmap(filename, dtype=dtype, mode='r', shape=shape, order='F' if fortran_order else 'C', offset=f.tell())
+
+    return arrays
+
+# Hidden Markov Model (θ) as an object, for long-running processes that decode many sequences
+# with the same model. It holds the parameters, and computes the quantities derived from them
+# (logarithms, transposed matrices) only when they are first needed, until the parameters are
+# updated. The transposed emission matrices are kept as contiguous arrays, so the emissions of
+# the observations of a sequence are gathered as whole rows. The model can be saved to a .npz
+# file, and loaded from it memory-mapped, so that it is ready to be used right away: the derived
+# arrays are saved too, in the layout used for decoding, and the decoders then use the mapped pages
+# directly. The derived arrays are computed with the given precision (dtype), e.g. np.float32 for
+# large batches, while the parameters themselves are saved with their own precision.
+
+class HiddenMarkovModel():
+    def __init__(self, a, b, initial_distribution, dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        self.update(a, b, initial_distribution)
+
+    def update(self, a=None, b=None, initial_distribution=None):
+        if a is not None:
+            self.a = a
+        if b is not None:
+            self.b = b
+        if initial_distribution is not None:
+            self.initial_distribution = initial_distribution
+        self.cache = {}
+
+    def cached(self, name, function):
+        value = self.cache.get(name)
+        if value is None:
+            value = function()
+            self.cache[name] = value
+        return value
+
+    @property
+    def transitions(self):
+        # The dense transition operator also keeps the logarithms of A once computed
+        def transitions():
+            if not isinstance(self.a, np.ndarray):
+                return self.a
+            return DenseTransitions(self.a.astype(self.dtype, copy=False), self.cache.get('log_a'))
+        return self.cached('transitions', transitions)
+
+    @property
+    def b_T(self):
+        return self.cached('b_T', lambda: np.ascontiguousarray(self.b.T, dtype=self.dtype))
+
+    @property
+    def typed_initial_distribution(self):
+        return self.cached('typed_initial_distribution', lambda: np.asarray(self.initial_distribution, dtype=self.dtype))
+
+    @property
+    def log_b_T(self):
+        def log_b_T():
+            with np.errstate(divide='ignore'):
+                return np.log(self.b_T)
+        return self.cached('log_b_T', log_b_T)
+
+    @property
+    def log_initial_distribution(self):
+        def log_initial_distribution():
+            with np.errstate(divide='ignore'):
+                return np.log(self.typed_initial_distribution)
+        return self.cached('log_initial_distribution', log_initial_distribution)
+
+    def forward(self, V):
+        return forward_scaled(V, self.transitions, self.b_T.T, self.typed_initial_distribution)
+
+    def log_likelihood(self, V):
+        alpha, c, log_likelihood = self.forward(V)
+        return log_likelihood
+
+    def posteriors(self, V):
+        alpha, c, log_likelihood = self.forward(V)
+        return alpha * backward_scaled(V, self.transitions, self.b_T.T, c)
+
+    def viterbi(self, V):
+        return viterbi_log(V, self.transitions, self.log_b_T.T, self.log_initial_distribution)
+
+    def save(self, filename):
+        a = self.a if isinstance(self.a, np.ndarray) else self.a.matrix
+        derived = {
+            'log_a': self.transitions.log_matrix,
+            'b_T': self.b_T,
+            'log_b_T': self.log_b_T,
+            'log_initial_distribution': self.log_initial_distribution,
+        }
+        save_parameters(filename, a, self.b, self.initial_distribution, **derived)
+
+    @classmethod
+    def load(cls, filename, mmap=True, dtype=np.float64):
+        if mmap:
+            arrays = load_npz_memmap(filename)
+            model = cls(arrays['a'], arrays['b'], arrays['initial_distribution'], dtype)
+            # The derived arrays saved with the same precision are used as they are
+            for name in ('log_a', 'b_T', 'log_b_T', 'log_initial_distribution'):
+                if name in arrays and arrays[name].dtype == model.dtype:
+                    model.cache[name] = arrays[name]
+            return model
+        return cls(*load_parameters(filename), dtype)
 
 def test_forward(V):
     # Transition Probabilities
@@ -160,6 +1162,80 @@ def test_backward(V):
     print(beta)
 
 
+def test_vectorized(V):
+    # Transition Probabilities
+    a = np.array(((0.54, 0.46), (0.49, 0.51)))
+
+    # Emission Probabilities
+    b = np.array(((0.16, 0.26, 0.58), (0.25, 0.28, 0.47)))
+
+    # Equal Probabilities for the initial distribution
+    initial_distribution = np.array((0.5, 0.5))
+
+    # Short prefix, so that the reference values have not underflowed to zero yet
+    V = V[:50]
+
+    alpha = forward(V, a, b, initial_distribution)
+    alpha_vectorized = forward_vectorized(V, a, b, initial_distribution)
+    print(f"Forward: max relative error = {np.max(np.abs(alpha_vectorized - alpha) / alpha)}")
+
+    beta = backward(V, a, b)
+    beta_vectorized = backward_vectorized(V, a, b)
+    print(f"Backward: max relative error = {np.max(np.abs(beta_vectorized - beta) / beta)}")
+
+    # The same with a transition operator instead of the matrix
+    a = DiagonalTransitions(2, 0.6)
+    alpha = forward(V, a.matrix, b, initial_distribution)
+    print(f"Forward with a transition operator: max relative error = {np.max(np.abs(forward_vectorized(V, a, b, initial_distribution) - alpha) / alpha)}")
+    beta = backward(V, a.matrix, b)
+    print(f"Backward with a transition operator: max relative error = {np.max(np.abs(backward_vectorized(V, a, b) - beta) / beta)}")
+
+
+def test_scaled(V):
+    # Transition Probabilities
+    a = np.array(((0.54, 0.46), (0.49, 0.51)))
+
+    # Emission Probabilities
+    b = np.array(((0.16, 0.26, 0.58), (0.25, 0.28, 0.47)))
+
+    # Equal Probabilities for the initial distribution
+    initial_distribution = np.array((0.5, 0.5))
+
+    alpha = forward(V[:50], a, b, initial_distribution)
+    alpha_scaled, c, log_likelihood = forward_scaled(V[:50], a, b, initial_distribution)
+    print(f"Log-likelihood of the first 50 observations: {np.log(np.sum(alpha[-1]))} (raw) ~ {log_likelihood} (scaled)")
+
+    # Integer weights are not truncated, and float32 emissions are kept as float32
+    alpha_scaled, c, log_likelihood = forward_scaled(V[:50], a, np.array(((16, 26, 58), (25, 28, 47))), initial_distribution)
+    print(f"Log-likelihood of integer emission weights: {log_likelihood - 50 * np.log(100)} ({alpha_scaled.dtype})")
+    alpha_scaled, c, log_likelihood = forward_scaled(V[:50], a, b.astype(np.float32), initial_distribution.astype(np.float32))
+    print(f"Log-likelihood with float32: {log_likelihood} ({alpha_scaled.dtype})")
+
+    # The whole sequence would underflow the raw probabilities
+    alpha_scaled, c, log_likelihood = forward_scaled(V, a, b, initial_distribution)
+    beta_scaled = backward_scaled(V, a, b, c)
+    gamma = alpha_scaled * beta_scaled
+    print(f"Log-likelihood of all the {V.shape[0]} observations: {log_likelihood}")
+    print(f"Posteriors sum to one: {np.allclose(np.sum(gamma, axis=1), 1.)}")
+
+
+def test_checkpointed(V):
+    # Transition Probabilities
+    a = np.array(((0.54, 0.46), (0.49, 0.51)))
+
+    # Emission Probabilities
+    b = np.array(((0.16, 0.26, 0.58), (0.25, 0.28, 0.47)))
+
+    # Equal Probabilities for the initial distribution
+    initial_distribution = np.array((0.5, 0.5))
+
+    alpha, c, log_likelihood = forward_scaled(V, a, b, initial_distribution)
+    gamma = alpha * backward_scaled(V, a, b, c)
+
+    for checkpoint_interval in (None, 1, 7, V.shape[0]):
+        same = np.array_equal(gamma, forward_backward_checkpointed(V, a, b, initial_distribution, checkpoint_interval))
+        print(f"Checkpoint interval {checkpoint_interval}: same posteriors as the full forward-backward: {same}")
+
 def test_baum_welch(V):
     # Transition Probabilities
     a = np.ones((2, 2))
@@ -175,6 +1251,82 @@ def test_baum_welch(V):
     print(baum_welch(V, a, b, initial_distribution, n_iter=100))
 
 
+def test_baum_welch_vectorized(V):
+    # Transition Probabilities
+    a = np.ones((2, 2))
+    a = a / np.sum(a, axis=1)
+
+    # Emission Probabilities
+    b = np.array(((1, 3, 5), (2, 4, 6)))
+    b = b / np.sum(b, axis=1).reshape((-1, 1))
+
+    # Equal Probabilities for the initial distribution
+    initial_distribution = np.array((0.5, 0.5))
+
+    a_reference, b_reference = baum_welch(V, a, b.copy(), initial_distribution, n_iter=100)
+    a, b = baum_welch_vectorized(V, a, b, initial_distribution, n_iter=100)
+    print((a, b))
+    print(f"Max error: {max(np.max(np.abs(a - a_reference)), np.max(np.abs(b - b_reference)))}")
+
+
+def test_baum_welch_until_convergence(V):
+    # Transition Probabilities
+    a = np.ones((2, 2))
+    a = a / np.sum(a, axis=1)
+
+    # Emission Probabilities
+    b = np.array(((1, 3, 5), (2, 4, 6)))
+    b = b / np.sum(b, axis=1).reshape((-1, 1))
+
+    # Equal Probabilities for the initial distribution
+    initial_distribution = np.array((0.5, 0.5))
+
+    a, b, trace = baum_welch_until_convergence(V, a, b, initial_distribution, max_iter=1000, tol=1e-6)
+    print(f"Converged after {len(trace)} iterations: log-likelihood {trace[0]} -> {trace[-1]}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'parameters.npz')
+        save_parameters(filename, a, b, initial_distribution)
+        a, b, trace = baum_welch_until_convergence(V, None, None, None, max_iter=1000, tol=1e-6, warm_start=filename)
+        print(f"Warm start: {len(trace)} iterations, log-likelihood {trace[0]} -> {trace[-1]}")
+
+def test_viterbi_training(V):
+    # Transition Probabilities
+    a = np.array(((0.6, 0.4), (0.4, 0.6)))
+
+    # Emission Probabilities
+    b = np.array(((1, 3, 5), (2, 4, 6)))
+    b = b / np.sum(b, axis=1).reshape((-1, 1))
+
+    # Equal Probabilities for the initial distribution
+    initial_distribution = np.array((0.5, 0.5))
+
+    for baum_welch_iter in (0, 10, 100):
+        a_trained, b_trained = viterbi_training(V, a, b, initial_distribution, baum_welch_iter=baum_welch_iter)
+        alpha, c, log_likelihood = forward_scaled(V, a_trained, b_trained, initial_distribution)
+        print(f"Viterbi training + {baum_welch_iter} iterations of Baum Welch: log-likelihood = {log_likelihood}")
+
+def test_baum_welch_corpus(V):
+    # Transition Probabilities
+    a = np.ones((2, 2))
+    a = a / np.sum(a, axis=1)
+
+    # Emission Probabilities
+    b = np.array(((1, 3, 5), (2, 4, 6)))
+    b = b / np.sum(b, axis=1).reshape((-1, 1))
+
+    # Equal Probabilities for the initial distribution
+    initial_distribution = np.array((0.5, 0.5))
+
+    # The same observations, split in several sequences
+    sequences = np.array_split(V, 8)
+
+    a_reference, b_reference = baum_welch_corpus(sequences, a, b, initial_distribution, n_iter=100, processes=1)
+    a, b = baum_welch_corpus(sequences, a, b, initial_distribution, n_iter=100)
+    print((a, b))
+    print(f"Max error (single process ~ process pool): {max(np.max(np.abs(a - a_reference)), np.max(np.abs(b - b_reference)))}")
+
+
 def test_viterbi(V):
     # Transition Probabilities
     a = np.ones((2, 2))
@@ -192,6 +1344,205 @@ def test_viterbi(V):
     print([['A', 'B'][int(s)] for s in viterbi(V, a, b, initial_distribution)])
 
 
+def test_viterbi_vectorized(V):
+    # Transition Probabilities
+    a = np.array(((0.54, 0.46), (0.49, 0.51)))
+
+    # Emission Probabilities
+    b = np.array(((0.16, 0.26, 0.58), (0.25, 0.28, 0.47)))
+
+    # Equal Probabilities for the initial distribution
+    initial_distribution = np.array((0.5, 0.5))
+
+    S = viterbi_vectorized(V, a, b, initial_distribution)
+    print(f"Same path as the reference implementation: {np.array_equal(S, viterbi(V, a, b, initial_distribution))}")
+
+    a = DiagonalTransitions(2, 0.6)
+    S = viterbi_vectorized(V, a, b, initial_distribution)
+    print(f"Same path with a transition operator: {np.array_equal(S, viterbi(V, a.matrix, b, initial_distribution))}")
+
+
+def test_transition_operators(V):
+    M = 5
+    a = DiagonalTransitions(M, 0.1)
+    dense = DenseTransitions(a.matrix)
+
+    # Random ω, with some -∞ (e.g. impossible states), down to only one finite state
+    rng = np.random.default_rng(0)
+    omega = rng.normal(size=(1000, M))
+    omega[rng.random(size=omega.shape) < 0.4] = -np.inf
+    omega[np.arange(100), rng.integers(M, size=100)] = 0.
+    omega[:100][omega[:100] != 0.] = -np.inf
+
+    value, prev = a.max_log(omega)
+    dense_value, dense_prev = dense.max_log(omega)
+    finite = dense_value > -np.inf
+    print(f"Diagonal ~ dense max_log: same values {np.array_equal(value, dense_value)}, same previous states {np.array_equal(prev[finite], dense_prev[finite])}")
+
+    # Sparse initial distribution
+    log_b = np.log(np.array(((0.3, 0.7), (0.7, 0.3), (0.4, 0.6))))
+    with np.errstate(divide='ignore'):
+        log_initial_distribution = np.log(np.array((1., 0., 0.)))
+    W = np.array((0, 1, 0, 1))
+    S = viterbi_log(W, DiagonalTransitions(3, 0.2), log_b, log_initial_distribution)
+    print(f"Same path with a sparse initial distribution: {np.array_equal(S, viterbi_log(W, DiagonalTransitions(3, 0.2).log_matrix, log_b, log_initial_distribution))}")
+
+
+def test_viterbi_batch(V):
+    # Transition Probabilities
+    a = np.array(((0.54, 0.46), (0.49, 0.51)))
+
+    # Emission Probabilities
+    b = np.array(((0.16, 0.26, 0.58), (0.25, 0.28, 0.47)))
+
+    # Equal Probabilities for the initial distribution
+    initial_distribution = np.array((0.5, 0.5))
+
+    # Sequences of different lengths
+    sequences = np.split(V, [50, 60, 200, 201, 350])
+
+    paths = viterbi_batch(sequences, np.log(a), np.log(b), np.log(initial_distribution))
+    same = all(np.array_equal(S, viterbi_vectorized(sequence, a, b, initial_distribution)) for S, sequence in zip(paths, sequences))
+    print(f"Same paths as decoding the {len(sequences)} sequences one by one: {same}")
+
+def test_viterbi_beam(V):
+    # Random model with many hidden states, that tend to stay in the same state
+    M = 200
+    K = 40
+    rng = np.random.default_rng(0)
+    V = rng.integers(0, K, V.shape[0])
+    a = np.full((M, M), 0.05 / (M - 1))
+    np.fill_diagonal(a, 0.95)
+    b = rng.random((M, K)) ** 8
+    b = b / np.sum(b, axis=1).reshape((-1, 1))
+    initial_distribution = np.ones(M) / M
+
+    for beam_width in (10, 50, 100):
+        S, differences, log_probability_gap = compare_viterbi_beam(V, np.log(a), np.log(b), np.log(initial_distribution), beam_width=beam_width)
+        print(f"Beam of {beam_width} states: {differences} states differ, log-probability {log_probability_gap:.3f} lower than the exact path")
+
+    for beam_threshold in (5., 10.):
+        S, differences, log_probability_gap = compare_viterbi_beam(V, np.log(a), np.log(b), np.log(initial_distribution), beam_threshold=beam_threshold)
+        print(f"Beam within {beam_threshold} of the best state: {differences} states differ, log-probability {log_probability_gap:.3f} lower than the exact path")
+
+def test_viterbi_nbest(V):
+    # Transition Probabilities
+    a = np.array(((0.54, 0.46), (0.49, 0.51)))
+
+    # Emission Probabilities
+    b = np.array(((0.16, 0.26, 0.58), (0.25, 0.28, 0.47)))
+
+    # Equal Probabilities for the initial distribution
+    initial_distribution = np.array((0.5, 0.5))
+
+    # All the 2^12 possible paths of the first 12 observations, sorted by log-probability
+    W = V[:12]
+    all_paths = [np.array([(p >> t) & 1 for t in range(W.shape[0])]) for p in range(2**W.shape[0])]
+    log_probabilities = sorted([path_log_probability(W, S, np.log(a), np.log(b), np.log(initial_distribution)) for S in all_paths], reverse=True)
+
+    paths = viterbi_nbest(W, np.log(a), np.log(b), np.log(initial_distribution), n=10)
+    print(f"Same 10 best log-probabilities as all the possible paths: {np.allclose([p for S, p in paths], log_probabilities[:10])}")
+    print(f"Different paths: {len(set(tuple(S) for S, p in paths))}")
+
+    paths = viterbi_nbest(V, np.log(a), np.log(b), np.log(initial_distribution), n=3)
+    print(f"Best path is the Viterbi path: {np.array_equal(paths[0][0], viterbi_vectorized(V, a, b, initial_distribution))}")
+
+def test_parallel(V):
+    # Transition Probabilities
+    a = np.array(((0.54, 0.46), (0.49, 0.51)))
+
+    # Emission Probabilities
+    b = np.array(((0.16, 0.26, 0.58), (0.25, 0.28, 0.47)))
+
+    # Equal Probabilities for the initial distribution
+    initial_distribution = np.array((0.5, 0.5))
+
+    alpha, c, log_likelihood = forward_scaled(V, a, b, initial_distribution)
+    alpha_parallel, c_parallel, log_likelihood_parallel = forward_parallel(V, a, b, initial_distribution, n_chunks=8)
+    print(f"Forward: max error = {np.max(np.abs(alpha_parallel - alpha))}, log-likelihood {log_likelihood_parallel} ~ {log_likelihood}")
+
+    S = viterbi_parallel(V, np.log(a), np.log(b), np.log(initial_distribution), n_chunks=8)
+    print(f"Viterbi: same path as the sequential implementation: {np.array_equal(S, viterbi_vectorized(V, a, b, initial_distribution))}")
+
+def test_incremental_viterbi(V):
+    # Transition Probabilities
+    a = np.array(((0.9, 0.1), (0.1, 0.9)))
+
+    # Emission Probabilities
+    b = np.array(((0.16, 0.26, 0.58), (0.25, 0.28, 0.47)))
+
+    # Equal Probabilities for the initial distribution
+    initial_distribution = np.array((0.5, 0.5))
+
+    decoder = IncrementalViterbi(V, np.log(a), np.log(b), np.log(initial_distribution))
+
+    rng = np.random.default_rng(0)
+    V = V.copy()
+    same = True
+    steps = 0
+    for n in range(100):
+        t = rng.integers(V.shape[0])
+        V[t] = rng.integers(3)
+        steps += decoder.update(t, V[t])
+        same = same and np.array_equal(decoder.S, viterbi_vectorized(V, a, b, initial_distribution))
+
+    print(f"Same paths as decoding the whole sequence again after each change: {same}")
+    print(f"Time steps recomputed per change: {steps / 100} (out of {V.shape[0]})")
+
+def test_model(V):
+    # Transition Probabilities
+    a = np.array(((0.54, 0.46), (0.49, 0.51)))
+
+    # Emission Probabilities
+    b = np.array(((0.16, 0.26, 0.58), (0.25, 0.28, 0.47)))
+
+    # Equal Probabilities for the initial distribution
+    initial_distribution = np.array((0.5, 0.5))
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'model.npz')
+        HiddenMarkovModel(a, b, initial_distribution).save(filename)
+        model = HiddenMarkovModel.load(filename)
+
+        print(f"Same path as viterbi_vectorized(): {np.array_equal(model.viterbi(V), viterbi_vectorized(V, a, b, initial_distribution))}")
+        print(f"Log-likelihood: {model.log_likelihood(V)}")
+        mapped = [isinstance(array, np.memmap) for array in (model.b, model.b_T, model.log_b_T, model.transitions.matrix, model.transitions.log_matrix)]
+        print(f"Memory-mapped arrays used for decoding: {all(mapped)}")
+
+        model.update(a=np.array(((0.9, 0.1), (0.1, 0.9))))
+        print(f"Log-likelihood after updating A: {model.log_likelihood(V)}")
+        del model
+
+        model = HiddenMarkovModel.load(filename, dtype=np.float32)
+        print(f"Same path with float32: {np.array_equal(model.viterbi(V), viterbi_vectorized(V, a, b, initial_distribution))}")
+        print(f"Log-likelihood with float32: {model.log_likelihood(V)} ({model.log_b_T.dtype})")
+
+        # The parameters keep their own precision when a float32 model is saved
+        model.save(filename)
+        del model
+        with np.load(filename) as data:
+            print(f"Saved precision: a {data['a'].dtype}, b {data['b'].dtype}, initial distribution {data['initial_distribution'].dtype}, log b {data['log_b_T'].dtype}")
+            print(f"Same parameters: {np.array_equal(data['a'], a) and np.array_equal(data['b'], b)}")
+
+def test_fixed_lag_viterbi(V):
+    # Transition Probabilities
+    a = np.array(((0.54, 0.46), (0.49, 0.51)))
+
+    # Emission Probabilities
+    b = np.array(((0.16, 0.26, 0.58), (0.25, 0.28, 0.47)))
+
+    # Equal Probabilities for the initial distribution
+    initial_distribution = np.array((0.5, 0.5))
+
+    S = viterbi_vectorized(V, a, b, initial_distribution)
+
+    for lag in (0, 2, 8, 32):
+        decoder = FixedLagViterbi(np.log(a), np.log(b), np.log(initial_distribution), lag)
+        committed = [s for s in (decoder.push(v) for v in V) if s is not None]
+        committed += decoder.flush()
+        print(f"Lag {lag}: {np.sum(np.array(committed) != S)} states differ from the full Viterbi path")
+
+
 def main():
     W = np.array(['B', 'B', 'B', 'B', 'B', 'B', 'B', 'B', 'B', 'B', 'B', 'B', 'B', 'B', 'B', 'B', 'B', 'B',
                   'B', 'B', 'B', 'B', 'A', 'A', 'A', 'A', 'A', 'A', 'A', 'A', 'A', 'A', 'B', 'B', 'B', 'B',
@@ -241,10 +1592,42 @@ def main():
     test_forward(V)
     print("\nTest: Backward:")
     test_backward(V)
+    print("\nTest: Vectorized Forward & Backward:")
+    test_vectorized(V)
+    print("\nTest: Scaled Forward & Backward:")
+    test_scaled(V)
+    print("\nTest: Checkpointed Forward-Backward:")
+    test_checkpointed(V)
     print("\nTest: Baum Welch:")
     test_baum_welch(V)
+    print("\nTest: Vectorized Baum Welch:")
+    test_baum_welch_vectorized(V)
+    print("\nTest: Baum Welch over a corpus:")
+    test_baum_welch_corpus(V)
+    print("\nTest: Baum Welch until convergence:")
+    test_baum_welch_until_convergence(V)
+    print("\nTest: Viterbi Training:")
+    test_viterbi_training(V)
     print("\nTest: Viterbi:")
     test_viterbi(V)
+    print("\nTest: Vectorized Viterbi:")
+    test_viterbi_vectorized(V)
+    print("\nTest: Transition Operators:")
+    test_transition_operators(V)
+    print("\nTest: Batched Viterbi:")
+    test_viterbi_batch(V)
+    print("\nTest: Beam search Viterbi:")
+    test_viterbi_beam(V)
+    print("\nTest: N-best Viterbi:")
+    test_viterbi_nbest(V)
+    print("\nTest: Parallel Forward & Viterbi:")
+    test_parallel(V)
+    print("\nTest: Incremental Viterbi:")
+    test_incremental_viterbi(V)
+    print("\nTest: Model object:")
+    test_model(V)
+    print("\nTest: Fixed-lag Viterbi:")
+    test_fixed_lag_viterbi(V)
 
 if __name__ == '__main__':
     main()
@@ -3,9 +3,15 @@
 
 import math
 import functools
+import glob
+import hashlib
 import operator
+import os
 import numpy as np
 
+from HiddenMarkovModel import DiagonalTransitions, FixedLagViterbi, IncrementalViterbi, backward_scaled, expected_counts, forward_scaled, state_index_dtype, viterbi_batch, viterbi_log, viterbi_nbest
+from MusicScale import MusicScale
+
 NUM_NOTES = 12
 NUM_MODES = 2
 
@@ -20,6 +26,18 @@ MUSIC_KEY_PROFILE_OFFSET = 4.
 MUSIC_KEY_FREQUENCIES_MAJOR = [math.exp(v - MUSIC_KEY_PROFILE_OFFSET)/(1. + math.exp(v - MUSIC_KEY_PROFILE_OFFSET)) for v in MUSIC_KEY_PROFILE_MAJOR]
 MUSIC_KEY_FREQUENCIES_MINOR = [math.exp(v - MUSIC_KEY_PROFILE_OFFSET)/(1. + math.exp(v - MUSIC_KEY_PROFILE_OFFSET)) for v in MUSIC_KEY_PROFILE_MINOR]
 
+# Key profiles that can be used instead of the default one, by name (or as a [major, minor] pair)
+MUSIC_KEY_PROFILES = {
+    'temperley': [MUSIC_KEY_PROFILE_MAJOR, MUSIC_KEY_PROFILE_MINOR],
+    'krumhansl_kessler': MusicScale.KEY_FINDING_KRUMHANSL_KESSLER,
+    'aarden_essen': MusicScale.KEY_FINDING_AARDEN_ESSEN,
+    'simple_pitch': MusicScale.KEY_FINDING_SIMPLE_PITCH,
+    'bellman_budge': MusicScale.KEY_FINDING_BELLMAN_BUDGE,
+    'temperley_kostka_payne': MusicScale.KEY_FINDING_TEMPERLEY_KOSTKA_PAYNE,
+}
+
+MUSIC_KEY_DEFAULT_PROFILE = 'temperley'
+
 MUSIC_KEY_K_MAJOR = sum([math.log(1-f) for f in MUSIC_KEY_FREQUENCIES_MAJOR])
 MUSIC_KEY_K_MINOR = sum([math.log(1-f) for f in MUSIC_KEY_FREQUENCIES_MINOR])
 
@@ -168,11 +186,20 @@ TEST_PITCH_HISTOGRAMS = [
         [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
 ]
 
-class StateChangeProbabilities():
-    def __init__(self, prob_same_state):
-        self.prob_same_state = prob_same_state
-        self.prob_other_state = (1. - self.prob_same_state) / (NUM_MODES * NUM_NOTES - 1)
-        self.shape = (NUM_MODES * NUM_NOTES, NUM_MODES * NUM_NOTES)
+class StateChangeProbabilities(DiagonalTransitions):
+    def __init__(self, prob_same_state, dtype=np.float64):
+        super().__init__(NUM_MODES * NUM_NOTES, prob_same_state, dtype=dtype)
+
+    @property
+    def prob_same_state(self):
+        return self._prob_same_state
+
+    @prob_same_state.setter
+    def prob_same_state(self, prob_same_state):
+        # The probabilities of changing to each of the other keys follow it, and then the dense
+        # matrices are built again the next time that they are used
+        self._prob_same_state = prob_same_state
+        self.prob_other_state = (1. - prob_same_state) / (NUM_MODES * NUM_NOTES - 1)
 
     def __getitem__(self, args):
         initial_state, final_state = args
@@ -186,20 +213,114 @@ class StateChangeProbabilities():
             return probability
 
         elif isinstance(initial_state, slice):
-            probabilities = np.array([self.prob_other_state] * NUM_MODES * NUM_NOTES)
-            probabilities[final_state] = self.prob_same_state
-            #print(f">>> InitialState={initial_state} ; FinalState={final_state} -> Probabilities={probabilities}")
-            return probabilities
+            # A (read-only) view of the cached dense matrix
+            return self.matrix[initial_state, final_state]
 
         else:
             raise TypeError("index must be int or slice")
 
+# Table of the logarithms of the Emission Probabilities of the 24 music keys (as mode * 12 + root)
+# for all the 2^12 sets of pitch classes, computed at once as two matrix products:
+#
+#   log P(o | key) = ∑p, o(p)·log F(key, p) + (1 - o(p))·log (1 - F(key, p))
+#
+# where o(p) is 1 when the pitch class p is in the set, and F(key, p) is the frequency of the
+# interval between p and the root of the key in the profile of its mode. The tables are saved to
+# MUSIC_KEY_CACHE_DIRECTORY as .npy files, named after a hash of the frequencies, and then loaded
+# memory-mapped, so that they are shared by all the processes and are not computed again.
+
+MUSIC_KEY_CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'KeyFindingHMM')
+
+PITCH_CLASS_SETS = (np.arange(2**NUM_NOTES).reshape((-1, 1)) >> np.arange(NUM_NOTES)) & 1
+
+def get_rotated_frequencies(major_frequencies, minor_frequencies):
+    frequencies = np.array([major_frequencies, minor_frequencies])
+    intervals = (np.arange(NUM_NOTES) - np.arange(NUM_NOTES).reshape((-1, 1))) % NUM_NOTES
+    return frequencies[:, intervals].reshape((NUM_MODES * NUM_NOTES, NUM_NOTES))
+
+def compute_log_emission_table(major_frequencies, minor_frequencies):
+    frequencies = get_rotated_frequencies(major_frequencies, minor_frequencies)
+    return np.log(frequencies).dot(PITCH_CLASS_SETS.T) + np.log(1. - frequencies).dot(1 - PITCH_CLASS_SETS.T)
+
+def load_log_emission_table(filename, compute_table):
+    try:
+        return np.load(filename, mmap_mode='r')
+    except (OSError, ValueError):
+        pass
+
+    table = compute_table()
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # Written to a temporary file first, so that other processes never load a partial table
+        temporary_filename = f'{filename}.{os.getpid()}.tmp'
+        with open(temporary_filename, 'wb') as f:
+            np.save(f, table)
+        os.replace(temporary_filename, filename)
+        return np.load(filename, mmap_mode='r')
+    except OSError:
+        return table
+
+log_emission_tables = {}
+
+def get_log_emission_table(major_frequencies=MUSIC_KEY_FREQUENCIES_MAJOR, minor_frequencies=MUSIC_KEY_FREQUENCIES_MINOR, dtype=np.float64, cached=True):
+    dtype = np.dtype(dtype)
+    frequencies = np.array([major_frequencies, minor_frequencies], dtype=np.float64)
+    if not cached:
+        # e.g. for frequencies that change all the time, as with OnlineMusicKeyEM
+        return compute_log_emission_table(frequencies[0], frequencies[1]).astype(dtype)
+
+    digest = hashlib.sha1(frequencies.tobytes()).hexdigest()[:16]
+
+    table = log_emission_tables.get((digest, dtype))
+    if table is None:
+        filename = os.path.join(MUSIC_KEY_CACHE_DIRECTORY, f'log_emissions_{digest}_{dtype.name}.npy')
+        table = load_log_emission_table(filename, lambda: compute_log_emission_table(frequencies[0], frequencies[1]).astype(dtype))
+        log_emission_tables[(digest, dtype)] = table
+    return table
+
+# Key profiles: the emission tables need the probability that each pitch class (relative to the
+# root note) is present in a bar. Profiles whose values are all in (0, 1) (Temperley-Kostka-Payne)
+# are already such probabilities. The others are weights, so they are first scaled to the range of
+# the default profile, 1.5 to 5, and then converted as the default one (logistic function with
+# MUSIC_KEY_PROFILE_OFFSET). The frequencies, the rotated matrices and the tables of each profile
+# are computed only once, and shared by the whole process.
+
+def get_profile(profile):
+    return MUSIC_KEY_PROFILES[profile] if isinstance(profile, str) else profile
+
+def get_profile_key(profile):
+    return profile if isinstance(profile, str) else tuple(tuple(float(v) for v in values) for values in profile)
+
+profile_frequencies = {}
+chroma_log_profiles = {}
+
+def get_profile_frequencies(profile=MUSIC_KEY_DEFAULT_PROFILE):
+    key = get_profile_key(profile)
+    frequencies = profile_frequencies.get(key)
+    if frequencies is None:
+        values = np.array(get_profile(profile), dtype=np.float64)
+        if np.all((values > 0.) & (values < 1.)):
+            frequencies = values
+        else:
+            values = 1.5 + 3.5 * (values - np.min(values)) / (np.max(values) - np.min(values))
+            frequencies = np.exp(values - MUSIC_KEY_PROFILE_OFFSET) / (1. + np.exp(values - MUSIC_KEY_PROFILE_OFFSET))
+        frequencies = (frequencies[0].tolist(), frequencies[1].tolist())
+        profile_frequencies[key] = frequencies
+    return frequencies
+
 class EmissionProbabilities():
-    def __init__(self):
+    def __init__(self, major_frequencies=MUSIC_KEY_FREQUENCIES_MAJOR, minor_frequencies=MUSIC_KEY_FREQUENCIES_MINOR, cached=True):
         self.data = [
-            MUSIC_KEY_FREQUENCIES_MAJOR + MUSIC_KEY_FREQUENCIES_MAJOR,
-            MUSIC_KEY_FREQUENCIES_MINOR + MUSIC_KEY_FREQUENCIES_MINOR,
+            list(major_frequencies) + list(major_frequencies),
+            list(minor_frequencies) + list(minor_frequencies),
         ]
+        self.log_table = get_log_emission_table(major_frequencies, minor_frequencies, cached=cached)
+        self.shape = self.log_table.shape
+        self.dtype = self.log_table.dtype
+
+    @classmethod
+    def from_profile(cls, profile=MUSIC_KEY_DEFAULT_PROFILE):
+        return cls(*get_profile_frequencies(profile))
 
     def get_probabilities(self, root_note, mode):
         return np.array(self.data[mode][12 - root_note:24 - root_note])
@@ -210,6 +331,10 @@ class EmissionProbabilities():
     def __getitem__(self, args):
         h, o = args
 
+        if isinstance(o, np.ndarray):
+            # b[:, V]: the probabilities of a whole sequence of observable states, as an M×T matrix
+            return np.exp(self.log_table[h, o])
+
         # This checks that:
         # - key is an integer (or can be converted to an integer)
         # - key is replaced by an appropriate positive value when < 0
@@ -217,34 +342,21 @@ class EmissionProbabilities():
         max_o = 2**12
         o = slice(o).indices(max_o)[1]
 
-        pitch_classes = [(o & 1<<(r%12) != 0) for r in range(0, 12)]
-        #print(f">>> HiddenStates={h} ; ObservableStates={o:03x} -> {pitch_classes}")
-
         if isinstance(h, int):
-            note = h % 12
-            mode = h // 12
-            raw_probabilities = self.get_probabilities(note, mode)
-            probabilities = self.get_probabilities_for_histogram(note, mode, o)
-            probability = functools.reduce(operator.mul, probabilities)
-            p1 = [round(p, 2) if c else math.nan for c, p in zip(pitch_classes, probabilities)]
-            p2 = [round(p, 2) if not c else math.nan for c, p in zip(pitch_classes, probabilities)]
-            #print(f">>> Note={note} ; Mode={mode} ; ObservableState={o:03x} ~ {o:012b} ; Data={p1}; {p2} -> {probability}")
-            return probability
+            return math.exp(self.log_table[h, o])
         elif isinstance(h, slice):
-            max_h = NUM_MODES * NUM_NOTES
-            v = np.array([0.5] * NUM_MODES * NUM_NOTES)
-            for i in range(*h.indices(max_h)):
-                note = i % 12
-                mode = i // 12
-                probabilities = self.get_probabilities(note, mode)
-                p1 = [round(p, 2) if c else math.nan for c, p in zip(pitch_classes, probabilities)]
-                p2 = [round(p, 2) if not c else math.nan for c, p in zip(pitch_classes, probabilities)]
-                #print(f">>> Note={note} ; Mode={mode} ; ObservableState={o:03x} ; Data={p1}; {p2}")
-            #print(f">>> Value={v}")
-            return v
+            # b[:, o]: the probabilities of all the (selected) hidden states, from a single column
+            return np.exp(self.log_table[h, o])
         else:
             raise TypeError("index must be int or slice")
 
+def get_music_key_log_emissions(dtype=np.float64, profile=MUSIC_KEY_DEFAULT_PROFILE):
+    return get_log_emission_table(*get_profile_frequencies(profile), dtype=dtype)
+
+def get_music_key_log_initial_distribution(dtype=np.float64):
+    # Equal Probabilities for the initial distribution
+    return np.full(NUM_MODES * NUM_NOTES, -np.log(NUM_MODES * NUM_NOTES), dtype=dtype)
+
 def viterbi(V, a, b, initial_distribution):
     T = V.shape[0]
     M = a.shape[0]
@@ -252,7 +364,7 @@ def viterbi(V, a, b, initial_distribution):
     omega = np.zeros((T, M))
     omega[0, :] = np.log(initial_distribution * b[:, V[0]])
 
-    prev = np.zeros((T - 1, M))
+    prev = np.zeros((T - 1, M), dtype=state_index_dtype(M))
 
     # ωi(t+1) = max(i, ωi(t)·aij·bjkv(t+1))
 
@@ -270,7 +382,7 @@ def viterbi(V, a, b, initial_distribution):
             omega[t, j] = np.max(probability)
 
     # Path Array
-    S = np.zeros(T)
+    S = np.zeros(T, dtype=np.intp)
 
     # Find the most probable last hidden state
     last_state = np.argmax(omega[T - 1, :])
@@ -289,13 +401,252 @@ def viterbi(V, a, b, initial_distribution):
     return S
 
 
-def find_music_key(pitch_histograms):
+def find_music_key(pitch_histograms, dtype=np.float64, profile=MUSIC_KEY_DEFAULT_PROFILE):
     V = np.array(pitch_histograms)
-    a = StateChangeProbabilities(0.8)
-    b = EmissionProbabilities()
-    initial_distribution = np.array([1] * NUM_MODES * NUM_NOTES)
-    initial_distribution = initial_distribution / np.sum(initial_distribution)
-    return [int(s) for s in viterbi(V, a, b, initial_distribution)]
+    a = StateChangeProbabilities(0.8, dtype)
+    return viterbi_log(V, a, get_music_key_log_emissions(dtype, profile), get_music_key_log_initial_distribution(dtype)).tolist()
+
+# Posterior probabilities P(key(t) | all the bars) of the 24 music keys for every bar, as a T×24
+# array, from a single scaled forward-backward pass. The emission probabilities of the song are
+# taken from the same table that find_music_key() uses.
+
+def find_music_key_posteriors(pitch_histograms, dtype=np.float64, profile=MUSIC_KEY_DEFAULT_PROFILE):
+    V = np.array(pitch_histograms)
+    a = StateChangeProbabilities(0.8, dtype)
+
+    # Emission probabilities of each bar, indexed by the number of the bar
+    b = np.exp(get_music_key_log_emissions(dtype, profile)[:, V])
+    bars = np.arange(V.shape[0])
+
+    alpha, c, log_likelihood = forward_scaled(bars, a, b, np.exp(get_music_key_log_initial_distribution(dtype)))
+    beta = backward_scaled(bars, a, b, c)
+    return alpha * beta
+
+# The n most probable sequences of music keys, for ambiguous passages (e.g. relative major and
+# minor keys), as a list of (music keys, log-probability) pairs
+
+def find_music_key_nbest(pitch_histograms, n=3, dtype=np.float64, profile=MUSIC_KEY_DEFAULT_PROFILE):
+    V = np.array(pitch_histograms)
+    a = StateChangeProbabilities(0.8, dtype)
+    return [(S.tolist(), float(log_probability)) for S, log_probability in viterbi_nbest(V, a, get_music_key_log_emissions(dtype, profile), get_music_key_log_initial_distribution(dtype), n)]
+
+# Music keys of several songs at once (e.g. all the MIDI files in a folder), as a list of lists
+
+def find_music_keys(pitch_histograms_per_song, dtype=np.float64, profile=MUSIC_KEY_DEFAULT_PROFILE):
+    sequences = [np.array(pitch_histograms) for pitch_histograms in pitch_histograms_per_song]
+    a = StateChangeProbabilities(0.8, dtype)
+    return [S.tolist() for S in viterbi_batch(sequences, a, get_music_key_log_emissions(dtype, profile), get_music_key_log_initial_distribution(dtype))]
+
+# Emissions from duration (or count) weighted chroma vectors, instead of the sets of pitch classes:
+# each bar is a 12-bin vector c(t) with how long (or how many times) each pitch class was played,
+# and each music key is a multinomial distribution over the pitch classes, given by its rotated
+# key profile normalized to sum one, q(key). Then:
+#
+#   log P(c(t) | key) = ∑p, cp(t)·log qp(key)   (plus a term that is the same for all the keys)
+#
+# so the emissions of all the bars for the 24 music keys are a single (T×12)·(12×24) product.
+
+def get_chroma_log_profiles(profile=MUSIC_KEY_DEFAULT_PROFILE):
+    key = get_profile_key(profile)
+    log_profiles = chroma_log_profiles.get(key)
+    if log_profiles is None:
+        profiles = get_rotated_frequencies(*get_profile(profile))
+        # Pitch classes with a weight of zero (e.g. in the simple pitch profiles) are kept possible
+        profiles = np.maximum(profiles, 1e-3 * np.max(profiles, axis=1, keepdims=True))
+        log_profiles = np.log(profiles / np.sum(profiles, axis=1, keepdims=True))
+        log_profiles.flags.writeable = False
+        chroma_log_profiles[key] = log_profiles
+    return log_profiles
+
+def get_chroma_log_emissions(chroma_per_bar, dtype=np.float64, profile=MUSIC_KEY_DEFAULT_PROFILE):
+    chroma = np.asarray(chroma_per_bar, dtype=dtype).reshape((-1, NUM_NOTES))
+    return chroma.dot(get_chroma_log_profiles(profile).T.astype(dtype))
+
+def find_music_key_from_chroma(chroma_per_bar, dtype=np.float64, profile=MUSIC_KEY_DEFAULT_PROFILE):
+    # Emissions indexed by the number of the bar, as in find_music_key_posteriors()
+    log_b = get_chroma_log_emissions(chroma_per_bar, dtype, profile).T
+    bars = np.arange(log_b.shape[1])
+    a = StateChangeProbabilities(0.8, dtype)
+    return viterbi_log(bars, a, log_b, get_music_key_log_initial_distribution(dtype)).tolist()
+
+# Online (stepwise) EM for the parameters of the music key model, adapting them to the music as it
+# is being played, without storing any history. After each bar, the expected sufficient statistics
+# of that bar alone are computed from the filtered probabilities of the keys (the probabilities
+# given the bars so far, which are updated in O(M) for the StateChangeProbabilities), and they are
+# mixed into running averages with a step size η(t) = (t + step_offset)^-step_exponent:
+#
+#   S(t) = (1 - η(t))·S(t-1) + η(t)·s(t)
+#
+# The statistics are the probability of staying in the same key, and for each mode the expected
+# number of times that each pitch class (relative to the root note) is present in a bar. The
+# parameters are then updated from them: prob_same_state, and the frequencies of the key profiles.
+# The step_offset controls how much weight the initial parameters keep at the beginning.
+#
+# Without a prior, the adaptation drifts to a model of the chords of each bar instead of the keys:
+# profiles with frequencies of 0 and 1 and a key change in most bars fit each bar better. So the
+# maximization step uses Beta priors centered on the initial parameters, worth prior_strength bars,
+# and prob_same_state is never lower than min_prob_same_state.
+
+ROTATIONS = (np.arange(NUM_NOTES).reshape((-1, 1)) + np.arange(NUM_NOTES)) % NUM_NOTES
+
+class OnlineMusicKeyEM():
+    def __init__(self, prob_same_state=0.8, major_frequencies=MUSIC_KEY_FREQUENCIES_MAJOR, minor_frequencies=MUSIC_KEY_FREQUENCIES_MINOR, step_exponent=0.6, step_offset=10., prior_strength=100., min_prob_same_state=0.5):
+        self.prob_same_state = prob_same_state
+        self.frequencies = np.array([major_frequencies, minor_frequencies])
+        self.step_exponent = step_exponent
+        self.step_offset = step_offset
+        self.prior_strength = prior_strength
+        self.min_prob_same_state = min_prob_same_state
+
+        # Beta priors, centered on the initial parameters
+        self.prior_prob_same_state = prob_same_state
+        self.prior_frequencies = self.frequencies.copy()
+
+        self.stay_statistic = prob_same_state
+        self.mode_statistics = np.ones(NUM_MODES)
+        self.presence_statistics = self.frequencies.copy()
+
+        self.t = 0
+        self.filter = None
+        self.transitions = StateChangeProbabilities(prob_same_state)
+
+    def emission_probabilities(self):
+        return EmissionProbabilities(self.frequencies[0], self.frequencies[1], cached=False)
+
+    def get_emissions(self, presence):
+        # Probabilities of the pitch classes in the bar for the 24 keys: with presence[(root + r) % 12]
+        # being the presence of the interval r above the root note, and the keys as mode * 12 + root
+        rotated = presence[ROTATIONS]
+        log_emissions = np.log(self.frequencies).dot(rotated.T) + np.log(1. - self.frequencies).dot(1. - rotated.T)
+        return np.exp(log_emissions.reshape(-1))
+
+    def push(self, pitch_classes):
+        presence = np.array([1. if pitch_classes & 1 << n else 0. for n in range(NUM_NOTES)])
+        emissions = self.get_emissions(presence)
+
+        if self.filter is None:
+            probabilities = emissions / np.sum(emissions)
+            stay_probability = self.prob_same_state
+        else:
+            predicted = self.transitions.dot_left(self.filter) * emissions
+            probabilities = predicted / np.sum(predicted)
+            # P(same key as in the previous bar | bars so far)
+            stay_probability = self.prob_same_state * np.sum(self.filter * emissions) / np.sum(predicted)
+
+        self.filter = probabilities
+        self.t += 1
+
+        # Sufficient statistics of this bar
+        probabilities = probabilities.reshape((NUM_MODES, NUM_NOTES))
+        mode_statistics = np.sum(probabilities, axis=1)
+        presence_statistics = probabilities.dot(presence[ROTATIONS])
+
+        eta = (self.t + self.step_offset) ** -self.step_exponent
+        if self.t > 1:
+            self.stay_statistic = (1. - eta) * self.stay_statistic + eta * stay_probability
+        self.mode_statistics = (1. - eta) * self.mode_statistics + eta * mode_statistics
+        self.presence_statistics = (1. - eta) * self.presence_statistics + eta * presence_statistics
+
+        # Maximization step (MAP), with the running averages worth 1/η(t) bars and the priors worth
+        # prior_strength bars, and keeping the probabilities away from 0 and 1
+        bars = 1. / eta
+        prob_same_state = (bars * self.stay_statistic + self.prior_strength * self.prior_prob_same_state) / (bars + self.prior_strength)
+        self.prob_same_state = float(np.clip(prob_same_state, self.min_prob_same_state, 1. - 1e-3))
+        self.transitions.prob_same_state = self.prob_same_state
+        frequencies = (bars * self.presence_statistics + self.prior_strength * self.prior_frequencies) / (bars * self.mode_statistics.reshape((-1, 1)) + self.prior_strength)
+        self.frequencies = np.clip(frequencies, 1e-3, 1. - 1e-3)
+
+        # Most probable key given the bars so far
+        return int(np.argmax(self.filter))
+
+# Incremental decoder for live input: push() the pitch classes of each bar as it ends, and it
+# returns the music key of the bar that was played lag bars before (None for the first ones)
+
+def create_music_key_decoder(lag=4, dtype=np.float64, profile=MUSIC_KEY_DEFAULT_PROFILE):
+    return FixedLagViterbi(StateChangeProbabilities(0.8, dtype), get_music_key_log_emissions(dtype, profile), get_music_key_log_initial_distribution(dtype), lag)
+
+# Decoder for songs that are edited after finding their music keys: update(bar, pitch_classes)
+# changes the pitch classes of a bar and decodes again only the bars around it, and the music keys
+# are then in the attribute S
+
+def create_incremental_music_key_decoder(pitch_histograms, checkpoint_interval=16, dtype=np.float64, profile=MUSIC_KEY_DEFAULT_PROFILE):
+    return IncrementalViterbi(pitch_histograms, StateChangeProbabilities(0.8, dtype), get_music_key_log_emissions(dtype, profile), get_music_key_log_initial_distribution(dtype), checkpoint_interval)
+
+# Pitch classes of each bar of a MIDI file, as MidiFileSoundPlayer finds them: the notes that are
+# sounding at the end of each bar, excluding the percussion channel
+
+def load_midi_pitch_histograms(filename):
+    import mido
+
+    midi_file = mido.MidiFile(filename)
+    time_signature_numerator = 4
+    time_signature_denominator = 4
+
+    count_ticks_in_measure = 0
+    pitch_histogram = [0] * NUM_NOTES
+    pitch_histograms = []
+    for message in mido.midifiles.tracks.merge_tracks(midi_file.tracks):
+        total_ticks_in_measure = midi_file.ticks_per_beat * time_signature_numerator * 4 / time_signature_denominator
+
+        if isinstance(message, mido.Message):
+            # A note_on with velocity 0 is a note_off
+            if message.type == 'note_on' and message.channel != 9:
+                pitch_histogram[message.note % 12] += 1 if message.velocity > 0 else -1
+            elif message.type == 'note_off' and message.channel != 9:
+                pitch_histogram[message.note % 12] -= 1
+            count_ticks_in_measure += message.time
+        elif message.type == 'time_signature':
+            time_signature_numerator = message.numerator
+            time_signature_denominator = message.denominator
+
+        while count_ticks_in_measure >= total_ticks_in_measure:
+            pitch_histograms.append(sum([1 << (n % 12) if pitch_histogram[n] > 0 else 0 for n in range(12)]))
+            count_ticks_in_measure -= total_ticks_in_measure
+
+    return pitch_histograms
+
+# Duration weighted chroma vectors of each bar of a MIDI file: how many beats each pitch class was
+# sounding in the bar, excluding the percussion channel
+
+def load_midi_chroma(filename):
+    import mido
+
+    midi_file = mido.MidiFile(filename)
+    time_signature_numerator = 4
+    time_signature_denominator = 4
+
+    count_ticks_in_measure = 0
+    pitch_histogram = np.zeros(NUM_NOTES)
+    chroma = np.zeros(NUM_NOTES)
+    chroma_per_bar = []
+    for message in mido.midifiles.tracks.merge_tracks(midi_file.tracks):
+        total_ticks_in_measure = midi_file.ticks_per_beat * time_signature_numerator * 4 / time_signature_denominator
+
+        # The notes that were sounding until this message, split at the ends of the bars
+        ticks = message.time
+        while count_ticks_in_measure + ticks >= total_ticks_in_measure:
+            chroma += (pitch_histogram > 0) * (total_ticks_in_measure - count_ticks_in_measure) / midi_file.ticks_per_beat
+            chroma_per_bar.append(chroma)
+            chroma = np.zeros(NUM_NOTES)
+            ticks -= total_ticks_in_measure - count_ticks_in_measure
+            count_ticks_in_measure = 0
+        chroma += (pitch_histogram > 0) * ticks / midi_file.ticks_per_beat
+        count_ticks_in_measure += ticks
+
+        if isinstance(message, mido.Message):
+            # A note_on with velocity 0 is a note_off
+            if message.type == 'note_on' and message.channel != 9:
+                pitch_histogram[message.note % 12] += 1 if message.velocity > 0 else -1
+            elif message.type == 'note_off' and message.channel != 9:
+                pitch_histogram[message.note % 12] -= 1
+        elif message.type == 'time_signature':
+            time_signature_numerator = message.numerator
+            time_signature_denominator = message.denominator
+
+    if count_ticks_in_measure:
+        chroma_per_bar.append(chroma)
+
+    return np.array(chroma_per_bar).reshape((-1, NUM_NOTES))
 
 def get_music_key_name(s):
     return '{}:{}'.format(NOTE_NAMES[int(s)%12], MODE_NAMES[int(s)//12])
@@ -333,6 +684,99 @@ def test_viterbi():
     print(['{:03x}={}:{}'.format(v, NOTE_NAMES[int(s)%12], MODE_NAMES[int(s)//12]) for v, s in zip(V, viterbi(V, a, b, initial_distribution))])
 
 
+def test_find_music_key():
+    pitch_histograms = [sum([1 << (n % 12) if pitch_histogram[n] > 0 else 0 for n in range(12)]) for pitch_histogram in TEST_PITCH_HISTOGRAMS]
+
+    a = StateChangeProbabilities(0.8)
+    b = EmissionProbabilities()
+    initial_distribution = np.array([1] * NUM_MODES * NUM_NOTES)
+    initial_distribution = initial_distribution / np.sum(initial_distribution)
+
+    reference = [int(s) for s in viterbi(np.array(pitch_histograms), a, b, initial_distribution)]
+    print(f"Same keys as the reference implementation: {find_music_key(pitch_histograms) == reference}")
+
+    posteriors = find_music_key_posteriors(pitch_histograms)
+    print(f"Probability of the Viterbi key of each bar: {np.round(posteriors[np.arange(len(reference)), reference], 2).tolist()}")
+
+    songs = [pitch_histograms[:40], pitch_histograms, pitch_histograms[40:100]]
+    print(f"Same keys when decoding several songs at once: {find_music_keys(songs) == [find_music_key(song) for song in songs]}")
+
+
+def test_emission_probabilities():
+    V = np.array([sum([1 << (n % 12) if pitch_histogram[n] > 0 else 0 for n in range(12)]) for pitch_histogram in TEST_PITCH_HISTOGRAMS])
+
+    a = StateChangeProbabilities(0.8)
+    b = EmissionProbabilities()
+    initial_distribution = np.full(NUM_MODES * NUM_NOTES, 1. / (NUM_MODES * NUM_NOTES))
+
+    # The emission probabilities object can be used directly by the algorithms of HiddenMarkovModel
+    alpha, c, log_likelihood = forward_scaled(V, a, b, initial_distribution)
+    bars = np.arange(V.shape[0])
+    alpha, c, table_log_likelihood = forward_scaled(bars, a, b[:, V], initial_distribution)
+    print(f"Log-likelihood: {log_likelihood} ~ {table_log_likelihood} (emissions of the whole song)")
+
+    transition_counts, emission_counts, log_likelihood = expected_counts(V, a, b, initial_distribution)
+    print(f"Expected counts: {np.sum(transition_counts):.6f} transitions, {np.sum(emission_counts):.6f} emissions (for {V.shape[0]} bars)")
+
+def test_precision():
+    songs = {'TEST_PITCH_HISTOGRAMS': [sum([1 << (n % 12) if pitch_histogram[n] > 0 else 0 for n in range(12)]) for pitch_histogram in TEST_PITCH_HISTOGRAMS]}
+
+    try:
+        for filename in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.mid'))):
+            songs[os.path.basename(filename)] = load_midi_pitch_histograms(filename)
+    except ImportError:
+        print("mido is not available, only the test pitch histograms are used")
+
+    for name, pitch_histograms in songs.items():
+        same = find_music_key(pitch_histograms, np.float32) == find_music_key(pitch_histograms, np.float64)
+        print(f"{name}: same keys with float32 and float64: {same}")
+
+    same = find_music_keys(list(songs.values()), np.float32) == find_music_keys(list(songs.values()), np.float64)
+    print(f"Same keys with float32 and float64 when decoding all the songs at once: {same}")
+
+def test_chroma():
+    # The test pitch histograms are already counts of each pitch class
+    keys = find_music_key_from_chroma(TEST_PITCH_HISTOGRAMS)
+    print(['{}'.format(get_music_key_name(s)) for s in keys])
+
+    try:
+        for filename in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.mid'))):
+            keys = find_music_key_from_chroma(load_midi_chroma(filename))
+            keys_from_pitch_classes = find_music_key(load_midi_pitch_histograms(filename))
+            n = min(len(keys), len(keys_from_pitch_classes))
+            same = np.mean(np.array(keys[:n]) == np.array(keys_from_pitch_classes[:n]))
+            print(f"{os.path.basename(filename)}: {get_music_key_name(max(set(keys), key=keys.count))} (same keys as from the pitch classes in {100 * same:.0f}% of the bars)")
+    except ImportError:
+        print("mido is not available, the MIDI files are not used")
+
+def test_profiles():
+    pitch_histograms = [sum([1 << (n % 12) if pitch_histogram[n] > 0 else 0 for n in range(12)]) for pitch_histogram in TEST_PITCH_HISTOGRAMS]
+
+    for profile in MUSIC_KEY_PROFILES:
+        keys = find_music_key(pitch_histograms, profile=profile)
+        keys_from_chroma = find_music_key_from_chroma(TEST_PITCH_HISTOGRAMS, profile=profile)
+        print(f"{profile}: {get_music_key_name(max(set(keys), key=keys.count))} ; from the chroma: {get_music_key_name(max(set(keys_from_chroma), key=keys_from_chroma.count))}")
+
+def test_online_em():
+    pitch_histograms = [sum([1 << (n % 12) if pitch_histogram[n] > 0 else 0 for n in range(12)]) for pitch_histogram in TEST_PITCH_HISTOGRAMS]
+
+    em = OnlineMusicKeyEM()
+    for n in range(10):
+        for pitch_classes in pitch_histograms:
+            em.push(pitch_classes)
+
+    print(f"Adapted probability of staying in the same key: {em.prob_same_state:.3f}")
+    print(f"Adapted major profile: {np.round(em.frequencies[0], 2).tolist()}")
+    print(f"Adapted minor profile: {np.round(em.frequencies[1], 2).tolist()}")
+
+    # The adapted model must still be a model of the keys: the test song stays in C major
+    keys = viterbi_log(np.array(pitch_histograms), em.transitions, em.emission_probabilities().log_table, get_music_key_log_initial_distribution()).tolist()
+    same = np.mean(np.array(keys) == np.array(find_music_key(pitch_histograms)))
+    print(f"Keys decoded with the adapted model: {sorted(set(get_music_key_name(s) for s in keys))} (same keys as with the initial model in {100 * same:.0f}% of the bars)")
+    assert em.prob_same_state >= 0.8
+    assert np.all(em.frequencies[:, 0] > 0.5) and np.all(em.frequencies[:, 1] < 0.5)
+    assert same >= 0.95
+
 def test_probability_conversion():
     print(f"Major: {MUSIC_KEY_PROFILE_MAJOR} -> {MUSIC_KEY_FREQUENCIES_MAJOR} (K = {MUSIC_KEY_K_MAJOR})")
     print(f"Minor: {MUSIC_KEY_PROFILE_MINOR} -> {MUSIC_KEY_FREQUENCIES_MINOR} (K = {MUSIC_KEY_K_MINOR})")
@@ -389,3 +833,9 @@ def test_probability_conversion():
 if __name__ == '__main__':
     test_probability_conversion()
     test_viterbi()
+    test_find_music_key()
+    test_emission_probabilities()
+    test_precision()
+    test_chroma()
+    test_profiles()
+    test_online_em()
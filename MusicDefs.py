@@ -207,13 +207,16 @@ class MusicDefs:
     # http://www.synthfont.com/links_to_soundfonts.html
     # https://www.kvraudio.com/forum/viewtopic.php?f=42&t=351893
 
-def ks_key(X):
+def ks_key(X, profile=None):
     '''Estimate the key from a pitch class distribution
     
     Parameters
     ----------
     X : np.ndarray, shape=(12,)
         Pitch-class energy distribution.  Need not be normalized
+
+    profile : list of two lists of 12 values (major, minor), optional
+        Key profiles, MusicScale.KEY_FINDING_KRUMHANSL_KESSLER by default
         
     Returns
     -------
@@ -228,14 +231,20 @@ def ks_key(X):
     import scipy.linalg
     import scipy.stats
 
+    # MusicScale imports this module
+    from MusicScale import MusicScale
+
     X = scipy.stats.zscore(X)
     
-    # Coefficients from Kumhansl and Schmuckler
+    # Coefficients from Kumhansl and Schmuckler by default
     # as reported here: http://rnhart.net/articles/key-finding/
-    major = np.asarray([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+    if profile is None:
+        profile = MusicScale.KEY_FINDING_KRUMHANSL_KESSLER
+
+    major = np.asarray(profile[0])
     major = scipy.stats.zscore(major)
     
-    minor = np.asarray([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+    minor = np.asarray(profile[1])
     minor = scipy.stats.zscore(minor)
     
     # Generate all rotations of major
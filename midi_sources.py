@@ -9,7 +9,7 @@ import sys
 from threading import Thread, Lock
 
 from GeneralMidi import MIDI_GM1_INSTRUMENT_NAMES, MIDI_PERCUSSION_NAMES
-from KeyFindingHMM import find_music_key, get_music_key_name, get_root_note_from_music_key, get_scale_from_music_key
+from KeyFindingHMM import create_music_key_decoder, find_music_key, get_music_key_name, get_root_note_from_music_key, get_scale_from_music_key
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
@@ -151,7 +151,11 @@ class MidiFileSoundPlayer():
             notes_off = []
 
             if isinstance(message, mido.Message):
-                if message.type == 'note_on':
+                if message.type == 'note_on' and message.velocity == 0: # Same as note_off
+                    if message.channel != 9: # Exclude percussion 
+                        pitch_histogram[message.note % 12] -= 1
+                        notes_off.append((message.channel, message.note))
+                elif message.type == 'note_on':
                     if message.channel != 9: # Exclude percussion 
                         pitch_histogram[message.note % 12] += 1
                         pitch_classes_in_beat |= 1 << (message.note % 12)
@@ -388,7 +392,7 @@ class MidiFileSoundPlayer():
         del self.fs
 
 class RtMidiSoundPlayer():
-    def __init__(self, keyboard_handlers=None):
+    def __init__(self, keyboard_handlers=None, bar_duration=2.0, music_key_lag=2):
         self.keyboard_handlers = keyboard_handlers
         self.fs = fluidsynth.Synth()
         self.fs.start(driver="alsa")
@@ -402,6 +406,17 @@ class RtMidiSoundPlayer():
         self.pitch_classes_active = [ 0 ] * 12
         self.pitch_classes_in_chord = 0
 
+        # There are no bars in live input, so the music key is found using fixed-length time slices.
+        # The slices are closed by a timer too, so that the music key keeps being updated during pauses
+        self.bar_duration = bar_duration
+        self.bar_start_timestamp = time.time_ns() / (10 ** 9)
+        self.pitch_classes_in_bar = 0
+        self.music_key_decoder = create_music_key_decoder(music_key_lag)
+        self.music_key_lock = Lock()
+        self.music_key_timer_running = True
+        self.music_key_timer = Thread(target=self.music_key_timer_loop, daemon=True)
+        self.music_key_timer.start()
+
         self.midi_in = rtmidi.MidiIn()
         available_ports = self.midi_in.get_ports()
         if available_ports:
@@ -424,6 +439,38 @@ class RtMidiSoundPlayer():
         eprint("FluidSynth Closed")
         del self.fs
 
+    def stop(self):
+        # Closes the current time slice, and decodes the last ones, which are still within the lag
+        self.music_key_timer_running = False
+        with self.music_key_lock:
+            self.close_time_slices(time.time_ns() / (10 ** 9))
+            self.music_key_decoder.push(self.pitch_classes_in_bar)
+            self.pitch_classes_in_bar = 0
+            for music_key in self.music_key_decoder.flush():
+                self.change_music_key(music_key)
+
+    def music_key_timer_loop(self):
+        while self.music_key_timer_running:
+            time.sleep(self.bar_duration / 4)
+            with self.music_key_lock:
+                if self.music_key_timer_running:
+                    self.close_time_slices(time.time_ns() / (10 ** 9))
+
+    def close_time_slices(self, current_timestamp):
+        # One slice for each bar_duration elapsed, with the notes still held going on to the next one
+        while current_timestamp - self.bar_start_timestamp >= self.bar_duration:
+            self.bar_start_timestamp += self.bar_duration
+            music_key = self.music_key_decoder.push(self.pitch_classes_in_bar)
+            self.pitch_classes_in_bar = self.pitch_classes_in_chord
+            if not music_key is None:
+                self.change_music_key(music_key)
+
+    def change_music_key(self, music_key):
+        eprint(f"Music key -> {get_music_key_name(music_key)}")
+        if self.keyboard_handlers:
+            for keyboard_handler in self.keyboard_handlers:
+                keyboard_handler.change_root(get_root_note_from_music_key(music_key), get_scale_from_music_key(music_key))
+
     def midi_received(self, midi_event, data=None):
         current_timestamp = time.time_ns() / (10 ** 9) # Converted to floating-point seconds
         midi_msg, delta_time = midi_event
@@ -434,15 +481,21 @@ class RtMidiSoundPlayer():
             octave = midi_msg[1] // 12
             channel = 16
 
-            if pressed:
-                self.pitch_classes_active[note % 12] += 1
-                self.pitch_classes_in_chord |= 1 << (note % 12)
-            else:
-                self.pitch_classes_active[note % 12] -= 1
-                if self.pitch_classes_active[note % 12] == 0:
-                    self.pitch_classes_in_chord &= ~(1 << (note % 12))
+            with self.music_key_lock:
+                # The slices that ended before this note belong to the chord as it was until now
+                self.close_time_slices(current_timestamp)
+
+                if pressed:
+                    self.pitch_classes_active[note % 12] += 1
+                    self.pitch_classes_in_chord |= 1 << (note % 12)
+                else:
+                    self.pitch_classes_active[note % 12] -= 1
+                    if self.pitch_classes_active[note % 12] == 0:
+                        self.pitch_classes_in_chord &= ~(1 << (note % 12))
+
+                #eprint("%s" % ((pressed, note, octave, pitch_class),))
 
-            #eprint("%s" % ((pressed, note, octave, pitch_class),))
+                self.pitch_classes_in_bar |= self.pitch_classes_in_chord
 
             if pressed: # A note was hit
                 if self.keyboard_handlers:
@@ -127,6 +127,7 @@ def main():
     pyglet.app.run()
 
     pyglet.clock.schedule_interval(update, 0, surface) # Specifying an interval of 0 prevents the function from being called again
+    midi_input.stop()
 
     if midi_thread:
         midi_thread.join()